@@ -2,7 +2,7 @@
 CREATE TABLE protein (
     protein_id serial,
     pdb_code character,
-    pdb_file json NOT NULL,
+    pdb_file bytea,
     nchains integer NOT NULL,
     nsites integer NOT NULL,
     PRIMARY KEY (protein_id),
@@ -12,12 +12,16 @@ CREATE TABLE protein (
 CREATE TABLE job (
     job_id serial,
     dat_time timestamp NOT NULL,
+    dat_time_start timestamp,
     dat_time_finish timestamp,
     email text,
     sub_id text NOT NULL,
+    status text NOT NULL DEFAULT 'submitted',
     PRIMARY KEY (job_id)
 );
 
+CREATE INDEX job_status_job_id_idx ON job (status, job_id);
+
 CREATE TABLE input (    
     input_id serial,
     job_id integer,
@@ -33,8 +37,8 @@ CREATE TABLE input (
 CREATE TABLE results (
     results_id serial,
     job_id integer,
-    tit_curve json,
-    pdb_out json,
+    tit_curve bytea,
+    pdb_out bytea,
     error text,
     isoelectric_point real,
     pdb_out_ph real,
@@ -72,3 +76,21 @@ create table usage_stats(
     pkai_subs       integer,
     PRIMARY KEY (usid)
 );
+
+create table usage_stats_bucket(
+    bucket  timestamp,
+    counter text,
+    count   integer NOT NULL,
+    PRIMARY KEY (bucket, counter)
+);
+
+create table job_fingerprint(
+    job_id          integer,
+    fingerprint     text NOT NULL,
+    source_job_id   integer,
+    PRIMARY KEY (job_id),
+    FOREIGN KEY (job_id) REFERENCES job(job_id),
+    FOREIGN KEY (source_job_id) REFERENCES job(job_id)
+);
+
+create index job_fingerprint_fingerprint_idx on job_fingerprint (fingerprint);
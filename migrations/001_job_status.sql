@@ -0,0 +1,16 @@
+-- Explicit job status maintained at every state transition
+ALTER TABLE job ADD COLUMN IF NOT EXISTS status text NOT NULL DEFAULT 'submitted';
+
+UPDATE job SET status = CASE
+    WHEN results.error IS NOT NULL THEN 'failed'
+    ELSE 'finished' END
+FROM results
+WHERE results.job_id = job.job_id;
+
+-- jobs without results older than the SLURM time limit will never report
+UPDATE job SET status = 'failed'
+WHERE status = 'submitted' AND dat_time < now() - interval '1 day';
+
+UPDATE job SET status = 'queued' WHERE status = 'submitted';
+
+CREATE INDEX IF NOT EXISTS job_status_job_id_idx ON job (status, job_id);
@@ -0,0 +1,89 @@
+"""Converts the JSON pdb files and titration curves to compressed bytea
+
+protein.pdb_file and results.pdb_out become compressed text and
+results.tit_curve a packed float64 array (see server/column_types.py).
+Rows are converted in batches into a new column that replaces the JSON
+one at the end, stop the servers while it runs. Safe to re-run.
+
+    python migrations/002_compressed_blobs.py
+"""
+
+import os
+import sys
+import json
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../server"))
+
+from sqlalchemy import text
+
+from database import ENGINE
+from column_types import CompressedText, PackedFloats
+
+BATCH_SIZE = 500
+
+COLUMNS = (
+    ("protein", "protein_id", "pdb_file", CompressedText()),
+    ("results", "job_id", "pdb_out", CompressedText()),
+    ("results", "job_id", "tit_curve", PackedFloats()),
+)
+
+
+def get_data_type(conn, table, column):
+    return conn.execute(
+        text("""SELECT data_type FROM information_schema.columns
+WHERE table_name = :table AND column_name = :column"""),
+        {"table": table, "column": column},
+    ).scalar()
+
+
+def migrate_column(table, key, column, column_type):
+    packed = f"{column}_packed"
+    with ENGINE.begin() as conn:
+        if get_data_type(conn, table, column) == "bytea":
+            print(f"{table}.{column} already converted")
+            return
+        conn.execute(
+            text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {packed} bytea")
+        )
+        conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} DROP NOT NULL"))
+
+    last, converted = None, 0
+    while True:
+        with ENGINE.begin() as conn:
+            rows = conn.execute(
+                text(f"""SELECT {key}, CAST({column} AS text) FROM {table}
+WHERE {column} IS NOT NULL AND (CAST(:last AS integer) IS NULL OR {key} > :last)
+ORDER BY {key} LIMIT :limit"""),
+                {"last": last, "limit": BATCH_SIZE},
+            ).all()
+            if not rows:
+                break
+
+            values = []
+            for row_key, value in rows:
+                value = json.loads(value)
+                if value is not None:
+                    values.append(
+                        {
+                            "key": row_key,
+                            "value": column_type.process_bind_param(value, None),
+                        }
+                    )
+            if values:
+                conn.execute(
+                    text(f"UPDATE {table} SET {packed} = :value WHERE {key} = :key"),
+                    values,
+                )
+            last = rows[-1][0]
+            converted += len(values)
+        print(f"{table}.{column}: {converted} rows converted")
+
+    with ENGINE.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+        conn.execute(text(f"ALTER TABLE {table} RENAME COLUMN {packed} TO {column}"))
+
+
+if __name__ == "__main__":
+    for table, key, column, column_type in COLUMNS:
+        migrate_column(table, key, column, column_type)
+    print("Done, run VACUUM FULL on protein and results to reclaim the space")
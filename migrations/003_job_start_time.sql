@@ -0,0 +1,2 @@
+-- When a job starts running, so that runtimes exclude the SLURM queue wait
+ALTER TABLE job ADD COLUMN IF NOT EXISTS dat_time_start timestamp;
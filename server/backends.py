@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import signal
+import logging
+import multiprocessing
+from queue import Queue
+
+from database import DB_SESSION
+from job_events import set_job_state
+from slurm import run_pypka_job, create_slurm_file, SlurmMonitor
+from cost_model import COST_MODEL, count_ph_points
+from const import CONFIG, DIR_PATH
+
+LOCAL_WORKERS = int(CONFIG.get("LOCAL_WORKERS") or 1)
+LOCAL_JOB_NCORES = int(CONFIG.get("LOCAL_JOB_NCORES") or 2)
+LOCAL_MAX_NSITES = int(CONFIG.get("LOCAL_MAX_NSITES") or 30)
+LOCAL_MAX_NATOMS = int(CONFIG.get("LOCAL_MAX_NATOMS") or 5000)
+LOCAL_TIME_LIMIT = float(CONFIG.get("LOCAL_TIME_LIMIT") or 600)  # seconds
+
+LOCAL_JOBS_KEY = "pypka:local_jobs"
+
+
+def count_atoms(pdb):
+    with open(pdb) as f:
+        return sum(1 for line in f if line.startswith(("ATOM ", "HETATM")))
+
+
+def run_local_job(job_params, subID, job_id, pid, cpus):
+    """Runs in a fresh process with its output going to the submission log
+
+    The job leads its own process group, so PypKa's workers can be killed
+    with it, and is pinned to cpus. stdout and stderr are redirected at the
+    file descriptor level so the log is the same as the one written by
+    sbatch -o/-e.
+    """
+    os.setsid()
+    os.sched_setaffinity(0, cpus)
+
+    fd = os.open(
+        f"{DIR_PATH}/submissions/{subID}.out", os.O_WRONLY | os.O_CREAT | os.O_APPEND
+    )
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    try:
+        run_pypka_job(job_params, subID, job_id, pid)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+class ExecutionBackend:
+    """Where a PypKa job runs
+
+    submit returns once the job is queued or, for local jobs, finished.
+    The job itself persists its results through run_pypka_job.
+    """
+
+    name = None
+
+    def accepts(self, job_params, nsites):
+        return True
+
+    def submit(self, job_params, subID, job_id, pid, nsites, nchains):
+        raise NotImplementedError
+
+
+class SlurmBackend(ExecutionBackend):
+    name = "slurm"
+
+    def submit(self, job_params, subID, job_id, pid, nsites, nchains):
+        nph = count_ph_points(job_params["pH"], job_params["pHstep"])
+        resources = COST_MODEL.get_resources(int(nsites), int(nchains), nph)
+        logging.info(f"{subID} resources: {resources}")
+
+        # PypKa uses as many processes as cores were allocated
+        job_params = {**job_params, "ncpus": resources.ncores}
+        create_slurm_file(job_params, subID, job_id, pid, resources)
+
+
+class LocalPoolBackend(ExecutionBackend):
+    """Runs small jobs on this machine, at most `workers` at a time
+
+    Jobs run inside the dispatcher task that submits them, so they are
+    bounded by the submission queue like any other job. A job is only
+    accepted while a worker slot is free, otherwise it goes to SLURM.
+
+    Every job gets a freshly spawned process (PypKa keeps its settings in
+    module globals) pinned to its own `ncores` cpus and limited to
+    `time_limit` seconds. With a redis `store` the running jobs are kept in
+    LOCAL_JOBS_KEY so those interrupted by a restart can be reported.
+    """
+
+    name = "local"
+
+    def __init__(self, workers, ncores, max_nsites, max_natoms, time_limit, store=None):
+        self.workers = workers
+        self.ncores = ncores
+        self.max_nsites = max_nsites
+        self.max_natoms = max_natoms
+        self.time_limit = time_limit
+        self.store = store
+        self.mp_context = multiprocessing.get_context("spawn")
+
+        # one set of cpus per worker, shared round-robin if there are too few
+        available = sorted(os.sched_getaffinity(0))
+        self.cpu_sets = Queue()
+        for i in range(workers):
+            start = i * ncores % len(available)
+            self.cpu_sets.put(
+                {available[(start + j) % len(available)] for j in range(ncores)}
+            )
+
+    def accepts(self, job_params, nsites):
+        if self.cpu_sets.empty() or int(nsites) > self.max_nsites:
+            return False
+        return count_atoms(job_params["structure"]) <= self.max_natoms
+
+    def submit(self, job_params, subID, job_id, pid, nsites, nchains):
+        job_params = {**job_params, "ncpus": self.ncores}
+
+        with DB_SESSION() as session:
+            set_job_state(session, job_id, "queued")
+            session.commit()
+        DB_SESSION.remove()
+
+        if self.store is not None:
+            job = {"job_id": job_id, "pid": pid}
+            self.store.hset(LOCAL_JOBS_KEY, subID, json.dumps(job))
+        try:
+            self.run(job_params, subID, job_id, pid)
+        except Exception:
+            # e.g. the dispatcher task timed out
+            SlurmMonitor.finish(subID, job_id, pid, "Job failed unexpectedly")
+            raise
+        finally:
+            if self.store is not None:
+                self.store.hdel(LOCAL_JOBS_KEY, subID)
+
+    def run(self, job_params, subID, job_id, pid):
+        # slots are checked in accepts, this only waits when several
+        # dispatcher threads raced for the last one
+        cpus = self.cpu_sets.get()
+        process = self.mp_context.Process(
+            target=run_local_job, args=(job_params, subID, job_id, pid, cpus)
+        )
+        try:
+            process.start()
+            process.join(self.time_limit)
+            timed_out = process.is_alive()
+            if timed_out:
+                self.kill_group(process.pid, signal.SIGTERM)
+                process.join(5)
+        finally:
+            if process.pid is not None:
+                # the group also holds any PypKa worker the job left behind
+                self.kill_group(process.pid, signal.SIGKILL)
+                process.kill()
+                process.join()
+            self.cpu_sets.put(cpus)
+
+        if timed_out:
+            SlurmMonitor.finish(subID, job_id, pid)
+        elif process.exitcode != 0:
+            logging.error(f"{subID} local job exited with {process.exitcode}")
+            SlurmMonitor.finish(subID, job_id, pid, "Job failed unexpectedly")
+
+    def restore(self):
+        """Reports the jobs that were running when the dispatcher stopped"""
+        for subID, job in self.store.hgetall(LOCAL_JOBS_KEY).items():
+            subID = subID.decode("utf-8")
+            job = json.loads(job)
+            logging.warning(f"{subID} local job interrupted by a restart")
+            SlurmMonitor.finish(
+                subID, job["job_id"], job["pid"], "Job interrupted by a server restart"
+            )
+            self.store.hdel(LOCAL_JOBS_KEY, subID)
+
+    @staticmethod
+    def kill_group(pgid, sig):
+        try:
+            os.killpg(pgid, sig)
+        except ProcessLookupError:
+            pass
+
+
+LOCAL_BACKEND = LocalPoolBackend(
+    LOCAL_WORKERS,
+    LOCAL_JOB_NCORES,
+    LOCAL_MAX_NSITES,
+    LOCAL_MAX_NATOMS,
+    LOCAL_TIME_LIMIT,
+)
+SLURM_BACKEND = SlurmBackend()
+BACKENDS = (LOCAL_BACKEND, SLURM_BACKEND)
+
+
+def get_backend(job_params, nsites):
+    for backend in BACKENDS:
+        if backend.accepts(job_params, nsites):
+            return backend
@@ -0,0 +1,15 @@
+import sys
+
+from const import PKPDB_SNAPSHOT
+from pkpdb_store import (
+    write_pkpdb_snapshot,
+    load_static_files,
+    get_static_files_version,
+)
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else PKPDB_SNAPSHOT
+    version = get_static_files_version()
+    write_pkpdb_snapshot(*load_static_files(), path, version)
+    print(f"pKPDB snapshot {version} written to {path}")
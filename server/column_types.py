@@ -0,0 +1,80 @@
+import gzip
+import struct
+
+import numpy as np
+from sqlalchemy.types import TypeDecorator, LargeBinary
+
+from const import CONFIG
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the first byte of every compressed value names its codec
+CODEC_GZIP = b"g"
+CODEC_ZSTD = b"z"
+
+BLOB_CODEC = CONFIG.get("BLOB_CODEC") or ("zstd" if zstandard else "gzip")
+BLOB_LEVEL = int(CONFIG.get("BLOB_LEVEL") or 6)
+
+
+def compress(data, codec=BLOB_CODEC, level=BLOB_LEVEL):
+    if codec == "zstd":
+        return CODEC_ZSTD + zstandard.ZstdCompressor(level=level).compress(data)
+    return CODEC_GZIP + gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def decompress(blob):
+    codec, data = blob[:1], blob[1:]
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd compressed values")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == CODEC_GZIP:
+        return gzip.decompress(data)
+    raise ValueError(f"Unknown compression codec {codec!r}")
+
+
+class CompressedText(TypeDecorator):
+    """Text stored as a compressed bytea, decoded on load"""
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return compress(value.encode("utf-8"))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decompress(bytes(value)).decode("utf-8")
+
+
+class PackedFloats(TypeDecorator):
+    """Rectangular nested lists of floats stored as a float64 bytea
+
+    The values are prefixed by the number of dimensions and the shape, and
+    are loaded back as nested lists.
+    """
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        array = np.asarray(value, dtype="<f8")
+        header = struct.pack(f"<B{array.ndim}I", array.ndim, *array.shape)
+        return header + array.tobytes()
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        value = bytes(value)
+        ndim = value[0]
+        shape = struct.unpack_from(f"<{ndim}I", value, 1)
+        offset = 1 + 4 * ndim
+        return np.frombuffer(value, dtype="<f8", offset=offset).reshape(shape).tolist()
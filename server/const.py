@@ -47,3 +47,5 @@ from dotenv import dotenv_values
 
 
 CONFIG = dotenv_values(f"{DIR_PATH}/../.env")
+
+PKPDB_SNAPSHOT = CONFIG.get("PKPDB_SNAPSHOT") or "static/pkpdb_snapshot"
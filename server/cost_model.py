@@ -0,0 +1,155 @@
+import math
+import logging
+import traceback
+from collections import namedtuple
+from threading import Lock
+from time import monotonic
+
+import numpy as np
+from sqlalchemy import extract
+
+from database import DB_SESSION
+from models import Job, Input, Protein, Results, JobFingerprint
+from const import CONFIG
+
+DEFAULT_NCORES = int(CONFIG.get("SLURM_JOB_NCORES") or 16)
+DEFAULT_WALLTIME = int(CONFIG.get("SLURM_WALLTIME") or 240)  # minutes
+MIN_NCORES = int(CONFIG.get("SLURM_MIN_NCORES") or 1)
+MAX_NCORES = int(CONFIG.get("SLURM_MAX_NCORES") or DEFAULT_NCORES)
+MIN_WALLTIME = int(CONFIG.get("SLURM_MIN_WALLTIME") or 10)
+MAX_WALLTIME = int(CONFIG.get("SLURM_MAX_WALLTIME") or DEFAULT_WALLTIME)
+# jobs are given enough cores to finish in about this many minutes
+TARGET_RUNTIME = float(CONFIG.get("SLURM_TARGET_RUNTIME") or 30)
+PARTITIONS = CONFIG.get("SLURM_PARTITIONS")
+# optional partitions for jobs whose walltime exceeds LONG_WALLTIME minutes
+LONG_PARTITIONS = CONFIG.get("SLURM_LONG_PARTITIONS")
+LONG_WALLTIME = int(CONFIG.get("SLURM_LONG_WALLTIME") or DEFAULT_WALLTIME)
+
+COST_MODEL_REFRESH = float(CONFIG.get("COST_MODEL_REFRESH") or 3600)  # seconds
+COST_MODEL_SAMPLES = 5000
+COST_MODEL_MIN_SAMPLES = 20
+# predictions are taken this many standard deviations above the fit
+SAFETY_Z = 2.0
+
+Resources = namedtuple("Resources", ["ncores", "walltime", "partitions"])
+
+
+def count_ph_points(pH, pHstep):
+    """Number of pH values of a submission, pH is "min,max" or a single value"""
+    bounds = [float(i) for i in str(pH).split(",")]
+    if len(bounds) == 1:
+        return 1
+    pHmin, pHmax = bounds
+    return int(round((pHmax - pHmin) / float(pHstep))) + 1
+
+
+def get_features(nsites, nchains, nph):
+    return [1.0, math.log(max(nsites, 1)), math.log(max(nchains, 1)), math.log(nph)]
+
+
+def load_history(session, limit=COST_MODEL_SAMPLES):
+    """(features, core-minutes) of the latest successful PypKa runs
+
+    The runtime is measured from the start of the run, jobs from before
+    the start time was recorded are left out.
+    """
+    rows = (
+        session.query(
+            Protein.nsites,
+            Protein.nchains,
+            Input.mc_set,
+            Input.pypka_set,
+            extract("epoch", Job.dat_time_finish - Job.dat_time_start),
+        )
+        .join(Input, Input.job_id == Job.job_id)
+        .join(Protein, Protein.protein_id == Input.protein_id)
+        .join(Results, Results.job_id == Job.job_id)
+        .outerjoin(JobFingerprint, JobFingerprint.job_id == Job.job_id)
+        .filter(Results.error.is_(None))
+        .filter(JobFingerprint.source_job_id.is_(None))
+        .filter(Job.dat_time_start.isnot(None))
+        .filter(Job.dat_time_finish.isnot(None))
+        .order_by(Job.job_id.desc())
+        .limit(limit)
+        .all()
+    )
+
+    features, costs = [], []
+    for nsites, nchains, mc_set, pypka_set, seconds in rows:
+        if not seconds or seconds <= 0 or not mc_set:
+            continue
+        nph = len(mc_set.get("pH_values") or []) or 1
+        # jobs submitted before ncpus was recorded all used the default
+        ncores = int((pypka_set or {}).get("ncpus") or DEFAULT_NCORES)
+        features.append(get_features(nsites, nchains, nph))
+        costs.append(float(seconds) / 60 * ncores)
+    return np.array(features), np.array(costs)
+
+
+class CostModel:
+    """Log-linear fit of the core-minutes of past jobs
+
+    log(core_minutes) ~ log(nsites) + log(nchains) + log(n_pH), refitted
+    from the job history every `refresh` seconds. Until there is enough
+    history every job gets the default allocation.
+    """
+
+    def __init__(self, refresh):
+        self.refresh = refresh
+        self.coefs = None
+        self.sigma = None
+        self.fitted_at = None
+        self.lock = Lock()
+
+    def fit(self, features, costs):
+        if len(costs) < COST_MODEL_MIN_SAMPLES:
+            self.coefs = None
+            return
+        log_costs = np.log(costs)
+        coefs, *_ = np.linalg.lstsq(features, log_costs, rcond=None)
+        residuals = log_costs - features @ coefs
+        self.coefs = coefs
+        self.sigma = float(np.std(residuals))
+
+    def update(self):
+        with self.lock:
+            if (
+                self.fitted_at is not None
+                and monotonic() - self.fitted_at < self.refresh
+            ):
+                return
+            self.fitted_at = monotonic()
+            try:
+                with DB_SESSION() as session:
+                    self.fit(*load_history(session))
+            except Exception:
+                logging.error(traceback.format_exc())
+            finally:
+                DB_SESSION.remove()
+
+    def predict(self, nsites, nchains, nph):
+        """Upper estimate of the core-minutes of a job, None without a fit"""
+        if self.coefs is None:
+            return None
+        log_cost = float(np.dot(get_features(nsites, nchains, nph), self.coefs))
+        return math.exp(log_cost + SAFETY_Z * self.sigma)
+
+    def get_resources(self, nsites, nchains, nph):
+        self.update()
+        core_minutes = self.predict(nsites, nchains, nph)
+        if core_minutes is None:
+            return Resources(DEFAULT_NCORES, DEFAULT_WALLTIME, PARTITIONS)
+
+        # PypKa splits the work by site, extra cores beyond that are idle
+        ncores = math.ceil(core_minutes / TARGET_RUNTIME)
+        ncores = max(MIN_NCORES, min(ncores, MAX_NCORES, max(nsites, 1)))
+        walltime = math.ceil(core_minutes / ncores)
+        walltime = max(MIN_WALLTIME, min(walltime, MAX_WALLTIME))
+
+        partitions = PARTITIONS
+        if LONG_PARTITIONS and walltime > LONG_WALLTIME:
+            partitions = LONG_PARTITIONS
+        return Resources(ncores, walltime, partitions)
+
+
+COST_MODEL = CostModel(COST_MODEL_REFRESH)
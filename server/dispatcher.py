@@ -0,0 +1,64 @@
+import logging
+from threading import Thread
+
+from redis import Redis
+from rq import SimpleWorker
+from rq.timeouts import TimerDeathPenalty
+
+from slurm import SLURM_MONITOR
+from backends import LOCAL_BACKEND, LOCAL_WORKERS
+from submission_queue import (
+    REDIS_URL,
+    SUBMISSION_QUEUE_NAME,
+    DISPATCHER_WORKERS,
+    REDIS,
+    fail_orphaned_submissions,
+)
+
+
+class DispatcherWorker(SimpleWorker):
+    """rq worker that runs the submissions in a thread of this process
+
+    Jobs are not forked so the SLURM monitor lives as long as the
+    dispatcher, and local jobs run in the worker thread that dispatched
+    them. Timeouts use timers since signals only reach the main thread.
+    """
+
+    death_penalty_class = TimerDeathPenalty
+
+    def _install_signal_handlers(self):
+        pass
+
+
+def run_worker():
+    worker = DispatcherWorker(
+        [SUBMISSION_QUEUE_NAME], connection=Redis.from_url(REDIS_URL)
+    )
+    worker.work()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(filename="server.log", level=logging.INFO)
+
+    # SLURM jobs submitted before a restart keep being followed, local
+    # jobs and dispatches died with the previous dispatcher and are
+    # reported as failed
+    SLURM_MONITOR.store = REDIS
+    SLURM_MONITOR.restore()
+    LOCAL_BACKEND.store = REDIS
+    LOCAL_BACKEND.restore()
+    fail_orphaned_submissions()
+
+    if LOCAL_WORKERS >= DISPATCHER_WORKERS:
+        logging.warning(
+            "DISPATCHER_WORKERS should exceed LOCAL_WORKERS, otherwise local "
+            "jobs can hold every dispatcher worker"
+        )
+
+    workers = [
+        Thread(target=run_worker, daemon=True) for _ in range(DISPATCHER_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,125 @@
+import gzip
+import hashlib
+import os
+import tempfile
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from const import CONFIG, DIR_PATH
+
+RCSB_URL = CONFIG.get("RCSB_URL") or "https://files.rcsb.org/download"
+ALPHAFOLD_URL = CONFIG.get("ALPHAFOLD_URL") or "https://alphafold.ebi.ac.uk/files"
+ALPHAFOLD_VERSION = CONFIG.get("ALPHAFOLD_VERSION") or "v4"
+DOWNLOAD_TIMEOUT = float(CONFIG.get("DOWNLOAD_TIMEOUT") or 30)
+
+STRUCTURE_CACHE_DIR = CONFIG.get("STRUCTURE_CACHE_DIR") or f"{DIR_PATH}/structure_cache"
+STRUCTURE_CACHE_SIZE = int(CONFIG.get("STRUCTURE_CACHE_MB") or 2048) * 1024**2
+
+FORMATS = {
+    "pdb": ".pdb",
+    "pdb.gz": ".pdb.gz",
+    "cif": ".cif",
+    "cif.gz": ".cif.gz",
+}
+
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+CACHE_LOCK = Lock()
+cache_bytes = None
+
+
+def get_source(idcode):
+    return "rcsb" if len(idcode) == 4 else "alphafold"
+
+
+def structure_url(idcode, source=None, fmt="pdb"):
+    source = source or get_source(idcode)
+    if source == "rcsb":
+        return f"{RCSB_URL}/{idcode.upper()}{FORMATS[fmt]}"
+    return (
+        f"{ALPHAFOLD_URL}/AF-{idcode.upper()}-F1-model_{ALPHAFOLD_VERSION}"
+        f"{FORMATS[fmt]}"
+    )
+
+
+def cache_path(idcode, source, fmt):
+    version = ALPHAFOLD_VERSION if source == "alphafold" else ""
+    key = f"{source}:{idcode.upper()}:{version}:{fmt}"
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return f"{STRUCTURE_CACHE_DIR}/{digest}{FORMATS[fmt]}"
+
+
+def evict_cache(new_bytes):
+    """Deletes the least recently used files once the cache exceeds its size"""
+    global cache_bytes
+    with CACHE_LOCK:
+        if cache_bytes is not None:
+            cache_bytes += new_bytes
+            if cache_bytes <= STRUCTURE_CACHE_SIZE:
+                return
+
+        entries = []
+        for entry in os.scandir(STRUCTURE_CACHE_DIR):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                fstat = entry.stat()
+                entries.append((fstat.st_mtime, fstat.st_size, entry.path))
+        cache_bytes = sum(size for _, size, _ in entries)
+
+        entries.sort()
+        target = STRUCTURE_CACHE_SIZE * 0.9
+        for _, size, path in entries:
+            if cache_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            cache_bytes -= size
+
+
+def fetch_structure(idcode, source=None, fmt="pdb"):
+    """Returns the structure file content or None if it does not exist upstream
+
+    Downloads go through a pooled session and are kept in an on-disk LRU
+    cache keyed by idcode, source, model version and format.
+    """
+    source = source or get_source(idcode)
+    fname = cache_path(idcode, source, fmt)
+
+    try:
+        with open(fname, "rb") as f:
+            content = f.read()
+        # the modification time doubles as the LRU recency
+        os.utime(fname)
+    except FileNotFoundError:
+        content = None
+
+    if content is not None:
+        if fmt.endswith(".gz"):
+            content = gzip.decompress(content)
+    else:
+        r = SESSION.get(structure_url(idcode, source, fmt), timeout=DOWNLOAD_TIMEOUT)
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        content = r.content
+
+        raw_content = content
+        if fmt.endswith(".gz"):
+            content = gzip.decompress(content)
+        if b"ATOM " not in content:
+            return None
+
+        os.makedirs(STRUCTURE_CACHE_DIR, exist_ok=True)
+        # unique per download, threads of a worker share its pid
+        fd, tmp_fname = tempfile.mkstemp(dir=STRUCTURE_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(raw_content)
+        os.replace(tmp_fname, fname)
+        evict_cache(len(raw_content))
+
+    return content.decode("utf-8")
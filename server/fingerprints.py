@@ -0,0 +1,135 @@
+import datetime
+import hashlib
+import json
+import logging
+
+from pypka import __version__ as pypka_version
+from sqlalchemy.dialects.postgresql import insert
+
+from models import Job, Input, Results, Residue, Pk, JobFingerprint
+from job_events import set_job_state
+from slurm import upsert_residues, residue_key
+
+# parameters that only name per-submission files or allocate resources
+FINGERPRINT_EXCLUDED = ("structure", "titration_output", "output", "ncpus")
+
+
+def canonical_structure(pdb):
+    """ATOM/HETATM records without line endings or trailing blanks"""
+    lines = []
+    with open(pdb) as f:
+        for line in f:
+            if line.startswith(("ATOM ", "HETATM")):
+                lines.append(line.rstrip())
+    return "\n".join(lines)
+
+
+def get_fingerprint(job_params):
+    """Hash of the structure and every parameter that changes the results"""
+    params = {
+        key: value
+        for key, value in job_params.items()
+        if key not in FINGERPRINT_EXCLUDED
+    }
+    if "structure_output" in params:
+        # the output path is per submission, its pH and naming scheme are not
+        params["structure_output"] = list(params["structure_output"][1:])
+
+    digest = hashlib.sha256()
+    digest.update(canonical_structure(job_params["structure"]).encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    digest.update(pypka_version.encode())
+    return digest.hexdigest()
+
+
+def find_source_job(session, fingerprint):
+    """Latest original job with this fingerprint that finished without errors"""
+    source = (
+        session.query(JobFingerprint.job_id)
+        .join(Results, Results.job_id == JobFingerprint.job_id)
+        .filter(JobFingerprint.fingerprint == fingerprint)
+        .filter(JobFingerprint.source_job_id.is_(None))
+        .filter(Results.error.is_(None))
+        .filter(Results.tit_curve.isnot(None))
+        .order_by(JobFingerprint.job_id.desc())
+        .first()
+    )
+    return source[0] if source else None
+
+
+def reuse_results(session, source_job_id, fingerprint, job_params, subID, job_id, pid):
+    """Copies the results of source_job_id to a new job in one transaction"""
+    source_input = (
+        session.query(Input.pypka_set, Input.pb_set, Input.mc_set)
+        .filter(Input.job_id == source_job_id)
+        .first()
+    )
+    source_results = (
+        session.query(
+            Results.tit_curve,
+            Results.isoelectric_point,
+            Results.pdb_out,
+            Results.pdb_out_ph,
+        )
+        .filter(Results.job_id == source_job_id)
+        .first()
+    )
+    pKas = (
+        session.query(Residue.chain, Residue.res_name, Residue.res_number, Pk.pk)
+        .filter(Residue.res_id == Pk.res_id)
+        .filter(Pk.job_id == source_job_id)
+        .all()
+    )
+
+    pypka_set, pb_set, mc_set = source_input
+    session.add(
+        Input(
+            job_id=job_id,
+            protein_id=pid,
+            pypka_set=pypka_set,
+            pb_set=pb_set,
+            mc_set=mc_set,
+        )
+    )
+
+    # a new upload is a new protein, its residues are created as usual
+    res_ids = upsert_residues(session, pid, pKas)
+    new_pks = [
+        {
+            "job_id": job_id,
+            "res_id": res_ids[residue_key(chain, res_name, res_number)],
+            "pk": pk,
+        }
+        for chain, res_name, res_number, pk in pKas
+    ]
+    if new_pks:
+        session.execute(insert(Pk), new_pks)
+
+    tit_curve, pI, pdb_out, pdb_out_ph = source_results
+    session.add(
+        Results(
+            job_id=job_id,
+            tit_curve=tit_curve,
+            isoelectric_point=pI,
+            pdb_out=pdb_out,
+            pdb_out_ph=pdb_out_ph,
+        )
+    )
+    if pdb_out and "structure_output" in job_params:
+        with open(job_params["structure_output"][0], "w") as f:
+            f.write(pdb_out)
+
+    session.add(
+        JobFingerprint(
+            job_id=job_id,
+            fingerprint=fingerprint,
+            source_job_id=source_job_id,
+        )
+    )
+    session.query(Job).filter(Job.job_id == job_id).update(
+        {Job.dat_time_finish: datetime.datetime.today()}
+    )
+    set_job_state(session, job_id, "finished")
+    session.commit()
+
+    logging.info(f"{subID} reused the results of job #{source_job_id}")
@@ -0,0 +1,73 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from cache import LRUCache
+from const import CONFIG
+from database import DB_SESSION
+from models import Job
+
+try:
+    import geoip2.database
+    import geoip2.errors
+except ImportError:
+    geoip2 = None
+
+GEOIP_DB = CONFIG.get("GEOIP_DB")
+GEOLOCATION_TIMEOUT = float(CONFIG.get("GEOLOCATION_TIMEOUT") or 5)
+GEOLOCATION_CACHE = LRUCache(10000, ttl=int(CONFIG.get("GEOLOCATION_TTL") or 86400))
+GEOLOCATION_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+geoip_reader = None
+if GEOIP_DB and geoip2:
+    geoip_reader = geoip2.database.Reader(GEOIP_DB)
+
+
+def locate_ip(ip):
+    """Returns (country, city) from the offline GeoIP database or ipinfo.io"""
+    location = GEOLOCATION_CACHE.get(ip)
+    if location:
+        return location
+
+    if geoip_reader:
+        try:
+            city = geoip_reader.city(ip)
+            location = (
+                city.country.iso_code or "Unknown",
+                city.city.name or "Unknown",
+            )
+        except (geoip2.errors.AddressNotFoundError, ValueError):
+            location = ("Unknown", "Unknown")
+    else:
+        try:
+            location_info = requests.get(
+                f"https://ipinfo.io/{ip}/json", timeout=GEOLOCATION_TIMEOUT
+            ).json()
+        except (requests.RequestException, ValueError) as e:
+            logging.warning(f"Geolocation of {ip} failed: {e}")
+            return ("Unknown", "Unknown")
+        location = (
+            location_info.get("country", "Unknown"),
+            location_info.get("city", "Unknown"),
+        )
+
+    GEOLOCATION_CACHE.set(ip, location)
+    return location
+
+
+def update_job_location(job_id, ip):
+    country, city = locate_ip(ip)
+    try:
+        with DB_SESSION() as session:
+            session.query(Job).filter(Job.job_id == job_id).update(
+                {Job.country: country, Job.city: city}
+            )
+            session.commit()
+    finally:
+        DB_SESSION.remove()
+
+
+def locate_job(job_id, ip):
+    """Fills in the job location in the background"""
+    GEOLOCATION_EXECUTOR.submit(update_job_location, job_id, ip)
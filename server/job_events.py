@@ -0,0 +1,97 @@
+import asyncio
+import json
+import logging
+
+import psycopg2
+import psycopg2.extensions
+from sqlalchemy import text
+
+JOB_EVENTS_CHANNEL = "job_events"
+
+# job.status of every published state
+JOB_STATUS = {
+    "queued": "queued",
+    "started": "running",
+    "finished": "finished",
+    "failed": "failed",
+}
+
+SET_STATE_QUERY = text(f"""UPDATE job SET status = CASE
+    -- a job can start before its submission is acknowledged
+    WHEN :status = 'queued' AND status <> 'submitted' THEN status
+    ELSE :status END
+WHERE job_id = :job_id
+RETURNING pg_notify('{JOB_EVENTS_CHANNEL}',
+    json_build_object('subID', sub_id, 'state', CAST(:state AS text))::text)""")
+
+
+def set_job_state(session, job_id, state):
+    """Stores and publishes a job state (queued, started, finished, failed)
+
+    NOTIFY is transactional, listeners only receive it once the session
+    commits together with the new job.status.
+    """
+    session.execute(
+        SET_STATE_QUERY,
+        {"job_id": job_id, "state": state, "status": JOB_STATUS[state]},
+    )
+
+
+class JobEventListener:
+    """Holds one LISTEN connection and fans the events out per subID
+
+    Every stream subscribes with its subID and gets an asyncio.Queue that
+    receives the states published for that submission.
+    """
+
+    def __init__(self, dsn, reconnect_delay=5):
+        self.dsn = dsn
+        self.reconnect_delay = reconnect_delay
+        self.subscribers = {}
+        self.conn = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        try:
+            self.conn = psycopg2.connect(self.dsn)
+            self.conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+            )
+            with self.conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {JOB_EVENTS_CHANNEL};")
+            loop.add_reader(self.conn.fileno(), self.handle)
+        except psycopg2.Error as e:
+            logging.error(f"Job events listener failed to connect: {e}")
+            loop.call_later(
+                self.reconnect_delay, lambda: asyncio.ensure_future(self.start())
+            )
+
+    def handle(self):
+        try:
+            self.conn.poll()
+        except psycopg2.Error as e:
+            logging.error(f"Job events listener lost its connection: {e}")
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(self.conn.fileno())
+            self.conn.close()
+            loop.call_later(
+                self.reconnect_delay, lambda: asyncio.ensure_future(self.start())
+            )
+            return
+
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            event = json.loads(notify.payload)
+            for queue in self.subscribers.get(event["subID"], ()):
+                queue.put_nowait(event["state"])
+
+    def subscribe(self, subID):
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(subID, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, subID, queue):
+        queues = self.subscribers.get(subID, set())
+        queues.discard(queue)
+        if not queues:
+            self.subscribers.pop(subID, None)
@@ -0,0 +1,82 @@
+import os
+
+# progress lines that overwrite the previous line of the same kind
+PROGRESS_PREFIXES = ("PB Runs", "MC Run")
+
+
+def get_progress_kind(line):
+    for i, prefix in enumerate(PROGRESS_PREFIXES, start=1):
+        if line.startswith(prefix):
+            return i
+    return 0
+
+
+class LogTail:
+    """Follows a PypKa log keeping the file offset and the last line kind
+
+    Only complete lines appended since the previous read are consumed,
+    ended by \n, \r or \r\n.
+    """
+
+    def __init__(self, path, offset=0, last_kind=0):
+        self.path = path
+        self.offset = offset
+        self.last_kind = last_kind
+
+    @classmethod
+    def from_event_id(cls, path, event_id):
+        """Resumes a tail from a Last-Event-ID, None if it does not fit the log"""
+        try:
+            offset, last_kind = (int(i) for i in event_id.split("-"))
+        except (AttributeError, ValueError):
+            return None
+        if offset <= 0 or not os.path.isfile(path) or offset > os.path.getsize(path):
+            return None
+        if last_kind not in range(len(PROGRESS_PREFIXES) + 1):
+            return None
+        return cls(path, offset, last_kind)
+
+    @property
+    def event_id(self):
+        return f"{self.offset}-{self.last_kind}"
+
+    def read(self):
+        """Returns (replace_last, new_lines)
+
+        When replace_last is True the first new line overwrites the last
+        line that was previously returned.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                previous = b""
+                if self.offset:
+                    f.seek(self.offset - 1)
+                    previous = f.read(1)
+                data = f.read()
+        except FileNotFoundError:
+            return False, []
+
+        if previous == b"\r" and data.startswith(b"\n"):
+            # the rest of a \r\n whose \r ended the previous read
+            data = data[1:]
+            self.offset += 1
+
+        # progress bars end their lines with \r only
+        end = max(data.rfind(b"\n"), data.rfind(b"\r")) + 1
+        self.offset += end
+
+        replace_last = False
+        lines = []
+        for line in data[:end].decode("utf-8", errors="replace").splitlines():
+            line = line.strip()
+            kind = get_progress_kind(line)
+            if kind and kind == self.last_kind:
+                if lines:
+                    lines[-1] = line
+                else:
+                    replace_last = True
+                    lines.append(line)
+            else:
+                lines.append(line)
+            self.last_kind = kind
+        return replace_last, lines
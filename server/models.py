@@ -1,6 +1,9 @@
 from sqlalchemy import Column, Integer, Date, CHAR, JSON, Time, Text, VARCHAR, REAL
-from sqlalchemy import ForeignKeyConstraint, UniqueConstraint
+from sqlalchemy import DateTime
+from sqlalchemy import ForeignKeyConstraint, UniqueConstraint, Index
+from sqlalchemy.orm import deferred
 from database import BASE
+from column_types import CompressedText, PackedFloats
 
 
 class Input(BASE):
@@ -18,15 +21,19 @@ class Input(BASE):
 
 class Job(BASE):
     __tablename__ = "job"
+    __table_args__ = (Index("job_status_job_id_idx", "status", "job_id"),)
 
     job_id = Column(Integer, primary_key=True)
     sub_id = Column(Text, nullable=False)
     dat_time = Column(Date, nullable=False)
+    dat_time_start = Column(Date)
     dat_time_finish = Column(Date, nullable=False)
     email = Column(Text)
     ip = Column(Text)
     country = Column(Text)
     city = Column(Text)
+    # submitted, queued, running, finished or failed
+    status = Column(Text, nullable=False, default="submitted")
 
 
 class Pk(BASE):
@@ -47,7 +54,8 @@ class Protein(BASE):
     nchains = Column(Integer(), nullable=False)
     nsites = Column(Integer, nullable=False)
     pdb_code = Column(CHAR, unique=True)
-    pdb_file = Column(JSON, nullable=False)
+    # compressed, only loaded when accessed
+    pdb_file = deferred(Column(CompressedText))
 
 
 class Residue(BASE):
@@ -59,6 +67,9 @@ class Residue(BASE):
     chain = Column(CHAR, nullable=False)
     res_number = Column(Integer, nullable=False)
     ForeignKeyConstraint(["protein_id"], ["protein.protein_id"])
+    __table_args__ = (
+        UniqueConstraint("protein_id", "chain", "res_name", "res_number"),
+    )
 
 
 class Results(BASE):
@@ -66,9 +77,9 @@ class Results(BASE):
 
     results_id = Column(Integer, primary_key=True)
     job_id = Column(Integer, nullable=False)
-    tit_curve = Column(JSON)
+    tit_curve = Column(PackedFloats)
     isoelectric_point = Column(REAL)
-    pdb_out = Column(JSON)
+    pdb_out = deferred(Column(CompressedText))
     pdb_out_ph = Column(REAL)
     error = Column(Text)
     ForeignKeyConstraint(["job_id"], ["job.job_id"])
@@ -82,3 +93,22 @@ class UsageStats(BASE):
     pkpdb_downloads = Column(Integer)
     pypka_subs = Column(Integer)
     pkai_subs = Column(Integer)
+
+
+class UsageStatsBucket(BASE):
+    __tablename__ = "usage_stats_bucket"
+
+    bucket = Column(DateTime, primary_key=True)
+    counter = Column(Text, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+
+class JobFingerprint(BASE):
+    __tablename__ = "job_fingerprint"
+
+    job_id = Column(Integer, primary_key=True)
+    fingerprint = Column(Text, nullable=False, index=True)
+    # set when the results were copied from an identical earlier job
+    source_job_id = Column(Integer)
+    ForeignKeyConstraint(["job_id"], ["job.job_id"])
+    ForeignKeyConstraint(["source_job_id"], ["job.job_id"])
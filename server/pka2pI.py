@@ -4,10 +4,11 @@ from pdbmender.utils import mend_pdb, add_tautomers
 from pdbmender.postprocess import fix_structure_states
 import numpy as np
 from copy import copy
-import pandas as pd
-from scipy.spatial.distance import pdist, squareform
+from scipy.spatial import cKDTree
 import os
 
+from structure import Structure, as_structure
+
 anionic_aas = ["CTR", "GLU", "ASP", "CYS", "TYR"]
 cationic_aas = ["NTR", "HIS", "ARG", "LYS"]
 
@@ -25,58 +26,122 @@ TITRABLETAUTOMERS = {
 }
 
 
-def pkas_2_titcurve(pdbfile, pKas, pH_range=[-20, 20], pH_step=0.5):
-    n_args = 0
-    chains = []
-    with open(pdbfile) as f:
-        for line in f:
-            if line.startswith("ATOM "):
-                cols = read_pdb_line(line)
-                atomname = cols[0]
-                resname = cols[2]
-                chain = cols[3]
+CHARGE_SIGNS = {
+    **{resname: 1.0 for resname in cationic_aas},
+    **{resname: -1.0 for resname in anionic_aas},
+}
 
-                if atomname == "C":
-                    if resname == "ARG":
-                        n_args += 1
 
-                if chain not in chains:
-                    chains.append(chain)
+def get_titration_sites(structure, pKas):
+    """Adds the termini of every chain to pKas and counts the arginines"""
+    structure = as_structure(structure)
+    n_args = int(
+        np.count_nonzero((structure.atom_names == "C") & (structure.resnames == "ARG"))
+    )
 
     pKas = copy(pKas)
-    for chain in chains:
+    for chain in structure.chain_list:
         pKas += [
             ["", "NTR", "", 7.99],
             ["", "CTR", "", 2.9],
         ]
+    return pKas, n_args
+
+
+def pkas_2_titcurve(structure, pKas, pH_range=[-20, 20], pH_step=0.5):
+    pKas, n_args = get_titration_sites(structure, pKas)
 
     pH_list = np.arange(pH_range[0], pH_range[1] + 1, pH_step).tolist()
     tit_x, tit_y = get_tit_curve(pKas, n_args, pH_list)
     return tit_x, tit_y
 
 
-def get_tit_curve(pKas, n_args, pH_list):
-    tit_x = []
-    tit_y = []
-    for pH in pH_list:
+def pkas_2_pI(structure, pKas, pH_range=[-20, 20]):
+    pKas, n_args = get_titration_sites(structure, pKas)
+    return get_pIs([pKas], [n_args], pH_range)[0]
+
+
+def get_site_arrays(batch_pKas):
+    """Flattens a batch of pKa lists into (protein index, pKa, charge sign) arrays"""
+    protein_idx, pkas, signs = [], [], []
+    for i, pKas in enumerate(batch_pKas):
+        for _, resname, _, res_pka in pKas:
+            protein_idx.append(i)
+            pkas.append(res_pka)
+            signs.append(CHARGE_SIGNS.get(resname, 0.0))
+    return (
+        np.array(protein_idx, dtype=int),
+        np.array(pkas, dtype=float),
+        np.array(signs, dtype=float),
+    )
 
-        charge = n_args
-        for tit_res in pKas:
-            _, resname, _, res_pka = tit_res
-            partial_occ = 1.0 / (10 ** (pH - res_pka) + 1.0)
-            if resname in cationic_aas:
-                partial_charge = partial_occ
-            elif resname in anionic_aas:
-                partial_charge = (1 - partial_occ) * -1
 
-            charge += partial_charge
+def get_site_charges(pkas, signs, pH):
+    """Average charge of each site at pH
 
-        tit_x.append(pH)
-        tit_y.append(round(charge, 2))
+    pH is either a scalar, one value per site or a row of values
+    broadcast against pkas[:, None].
+    """
+    with np.errstate(over="ignore"):
+        occ = 1.0 / (10.0 ** (pH - pkas) + 1.0)
+    # cationic sites carry the occupancy, anionic ones occupancy - 1
+    return np.where(signs > 0, occ, 0.0) + np.where(signs < 0, occ - 1.0, 0.0)
 
+
+def get_tit_curves(batch_pKas, batch_n_args, pH_list):
+    """Charge vs pH matrix (proteins x pH values) of a batch of proteins"""
+    protein_idx, pkas, signs = get_site_arrays(batch_pKas)
+    pH_values = np.asarray(pH_list, dtype=float)
+
+    charges = np.repeat(
+        np.asarray(batch_n_args, dtype=float)[:, None], len(pH_values), axis=1
+    )
+    site_charges = get_site_charges(pkas[:, None], signs[:, None], pH_values)
+    np.add.at(charges, protein_idx, site_charges)
+    return charges
+
+
+def get_tit_curve(pKas, n_args, pH_list):
+    charges = get_tit_curves([pKas], [n_args], pH_list)[0]
+    tit_x = list(pH_list)
+    tit_y = np.round(charges, 2).tolist()
     return tit_x, tit_y
 
 
+def get_pIs(batch_pKas, batch_n_args, pH_range=[-20, 20], tolerance=1e-6):
+    """Isoelectric points of a batch of proteins
+
+    The charge is a monotonically decreasing function of pH, so the root is
+    found by bisecting all proteins simultaneously. Proteins that do not
+    change sign within pH_range get the corresponding range limit.
+    """
+    protein_idx, pkas, signs = get_site_arrays(batch_pKas)
+    n_args = np.asarray(batch_n_args, dtype=float)
+    nproteins = len(n_args)
+
+    def charge_at(pH_values):
+        site_charges = get_site_charges(pkas, signs, pH_values[protein_idx])
+        return n_args + np.bincount(
+            protein_idx, weights=site_charges, minlength=nproteins
+        )
+
+    low = np.full(nproteins, float(pH_range[0]))
+    high = np.full(nproteins, float(pH_range[1]))
+    always_negative = charge_at(low) <= 0.0
+    always_positive = charge_at(high) > 0.0
+
+    while np.any(high - low > tolerance):
+        mid = (low + high) / 2
+        positive = charge_at(mid) > 0.0
+        low = np.where(positive, mid, low)
+        high = np.where(positive, high, mid)
+
+    pIs = (low + high) / 2
+    pIs[always_negative] = pH_range[0]
+    pIs[always_positive] = pH_range[1]
+    return pIs.tolist()
+
+
 def titcurve_2_pI(tit_x, tit_y):
     titration_curve = [(pH, tit_y[i]) for i, pH in enumerate(tit_x)]
     i = 0
@@ -92,8 +157,8 @@ def titcurve_2_pI(tit_x, tit_y):
         return isoelectric_point
 
 
-def exclude_cys(pdbfile, pkas):
-    to_exclude = identify_cys_cys_bridges(pdbfile)
+def exclude_cys(structure, pkas):
+    to_exclude = identify_cys_cys_bridges(structure)
 
     final_pkas = []
 
@@ -112,105 +177,66 @@ def exclude_cys(pdbfile, pkas):
     return final_pkas
 
 
-def identify_cys_cys_bridges(pdbfile):
-    cys_atoms = []
-    with open(pdbfile) as f:
-        for line in f:
-            if line.startswith("ATOM "):
-                cols = read_pdb_line(line)
-                resname = cols[2]
-                if resname == "CYS":
-                    cys_atoms.append(cols)
-    if len(cys_atoms) == 0:
+def identify_cys_cys_bridges(structure, cutoff=3.5):
+    """Cysteines with any atom closer than cutoff to an atom of another cysteine"""
+    structure = as_structure(structure)
+    is_cys = structure.resnames == "CYS"
+
+    cys_res = []
+    cys_res_index = {}
+    atom_res = []
+    for res in zip(
+        structure.chains[is_cys].tolist(), structure.resnumbs[is_cys].tolist()
+    ):
+        if res not in cys_res_index:
+            cys_res_index[res] = len(cys_res)
+            cys_res.append(list(res))
+        atom_res.append(cys_res_index[res])
+    if len(cys_res) < 2:
         return []
-    df_cys = pd.DataFrame(
-        cys_atoms,
-        columns=["anumb", "aname", "resname", "chain", "resnumb", "x", "y", "z"],
-    )
-
-    cys_res = (
-        df_cys[["chain", "resnumb"]]
-        .value_counts()
-        .reset_index(name="count")[["chain", "resnumb"]]
-        .values.tolist()
-    )
-
-    dists = squareform(pdist(df_cys[["x", "y", "z"]]))
 
-    to_exclude = []
-    for i, i_cys in enumerate(cys_res):
-        i_indices = df_cys.query(
-            f"chain == '{i_cys[0]}' and resnumb == {i_cys[1]}"
-        ).index.values.tolist()
+    atom_res = np.array(atom_res)
+    coords = structure.coords[is_cys]
 
-        mindist = 9999
-        # mindist_residues = -1
-        for atom_i in i_indices:
-            dists_i = dists[atom_i]
-            for ii in range(len(cys_res)):
-                if ii == i:
-                    continue
-                ii_cys = cys_res[ii]
-                ii_indices = df_cys.query(
-                    f"chain == '{ii_cys[0]}' and resnumb == {ii_cys[1]}"
-                ).index.values.tolist()
+    pairs = cKDTree(coords).query_pairs(cutoff, output_type="ndarray")
+    atoms_i, atoms_j = pairs[:, 0], pairs[:, 1]
+    dists = np.linalg.norm(coords[atoms_i] - coords[atoms_j], axis=1)
+    res_i, res_j = atom_res[atoms_i], atom_res[atoms_j]
+    close = (res_i != res_j) & (dists < cutoff)
 
-                dists_i_atom_vs_ii_cys = min(dists_i[ii_indices])
+    bridged = np.zeros(len(cys_res), dtype=bool)
+    bridged[res_i[close]] = True
+    bridged[res_j[close]] = True
 
-                if dists_i_atom_vs_ii_cys < mindist:
-                    mindist = dists_i_atom_vs_ii_cys
-                    # mindist_residues = ii_cys
-
-        if mindist < 3.5:
-            to_exclude.append(i_cys)
-
-    return to_exclude
+    return [cys_res[i] for i in np.flatnonzero(bridged)]
 
 
 def clean_pdb(f_pdb, new_f_pdb):
-    atom_lines = []
-    with open(f_pdb) as f:
-        for line in f:
-            if line.startswith("ATOM "):
-                atom_lines.append(line)
-            elif line.startswith("END"):
-                break
-
-    with open(new_f_pdb, "w") as f_new:
-        f_new.write("".join(atom_lines))
+    structure = Structure.from_pdb(f_pdb, first_model_only=True)
+    structure.write(new_f_pdb)
+    return structure
 
 
 def pkas_2_pdb(
-    subID, inputpdbfilename, outputfilename, outputfilepH, outputfilenaming, results
+    subID, structure, outputfilename, outputfilepH, outputfilenaming, results
 ):
-    resnames = {}
-    with open(inputpdbfilename) as f:
-        for line in f:
-            if line.startswith("ATOM "):
-                cols = read_pdb_line(line)
-                resname = cols[2]
-                resnumb = cols[4]
-                chain = cols[3]
-                if chain not in resnames:
-                    resnames[chain] = {}
-                resnames[chain][resnumb] = resname
+    structure = as_structure(structure)
+    inputpdbfilename = structure.filename
+    resnames = structure.residues
 
     terminal_offset = 5000
 
+    _, pkas, signs = get_site_arrays([results["pKas"]])
+    site_charges = np.round(get_site_charges(pkas, signs, outputfilepH), 2).tolist()
+
     sites = {}
     chains_res = {}
-    for chain, resname, resnumb, pKa in results["pKas"]:
+    for (chain, resname, resnumb, pKa), charge in zip(results["pKas"], site_charges):
         termini_resname = ""
         if resname in ("NTR", "CTR"):
             resnumb += terminal_offset
             termini_resname = resnames[chain][resnumb]
 
-        tit_x, tit_y = get_tit_curve(
-            [[chain, resname, resnumb, pKa]], 0, [outputfilepH]
-        )
-        tit_curve = {x: y for x, y in zip(tit_x, tit_y)}
-
-        charge = tit_curve[outputfilepH]
         if resname in cationic_aas:
             avg_prot = charge
             if avg_prot >= 0.5:
@@ -248,7 +274,7 @@ def pkas_2_pdb(
         chains_res[chain][resnumb] = resname
 
     cys_bridges = {}
-    cys_bridges_list = identify_cys_cys_bridges(inputpdbfilename)
+    cys_bridges_list = identify_cys_cys_bridges(structure)
     for chain, resnumb in cys_bridges_list:
         if chain not in cys_bridges:
             cys_bridges[chain] = []
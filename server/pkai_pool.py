@@ -0,0 +1,148 @@
+import os
+import copy
+import hashlib
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+import torch
+import pkai.pKAI as pkai_module
+from pkai.pKAI import pKAI
+
+from pka2pI import pkas_2_titcurve, pkas_2_pI, exclude_cys
+from structure import Structure
+from const import CONFIG
+
+PKAI_MODELS = ("pKAI", "pKAI+")
+PKAI_THREADS = int(CONFIG.get("PKAI_THREADS") or 2)
+# every web worker process has its own pool, together they share the cpus
+WEB_WORKERS = int(CONFIG.get("WEB_WORKERS") or os.environ.get("WEB_CONCURRENCY") or 1)
+PKAI_WORKERS = int(
+    CONFIG.get("PKAI_WORKERS")
+    or max(1, (os.cpu_count() or 1) // (PKAI_THREADS * WEB_WORKERS))
+)
+
+WORKER_THREADS = None
+
+
+def init_worker(threads, models):
+    """Runs once in every pool process: pins the torch threads and loads the models"""
+    global WORKER_THREADS
+    WORKER_THREADS = threads
+
+    torch.set_num_threads(threads)
+
+    # pKAI() reloads the model weights on every call, keep them in memory instead
+    if hasattr(pkai_module, "load_model"):
+        pkai_module.load_model = functools.lru_cache(maxsize=None)(
+            pkai_module.load_model
+        )
+        for model in models:
+            pkai_module.load_model(model, "cpu")
+
+
+def predict(pdb, model):
+    results = pKAI(pdb, model_name=model, device="cpu", threads=WORKER_THREADS)
+    results = [[i[0], i[2], i[1], i[3]] for i in results]
+    structure = Structure.from_pdb(pdb)
+    results = exclude_cys(structure, results)
+    tit_x, tit_y = pkas_2_titcurve(structure, results)
+    pI = pkas_2_pI(structure, results)
+    return {"pKas": results, "tit_x": tit_x, "tit_y": tit_y, "pI": round(pI, 2)}
+
+
+class PkaiPool:
+    """Long-lived pKAI inference processes shared by the request threads
+
+    The processes are spawned on first use so that forking web servers do
+    not inherit a half-initialized executor.
+    """
+
+    def __init__(self, workers, threads, models=PKAI_MODELS):
+        self.workers = workers
+        self.threads = threads
+        self.models = models
+        self.executor = None
+        self.lock = Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_worker,
+                    initargs=(self.threads, self.models),
+                )
+            return self.executor
+
+    def reset(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def submit(self, func, *args):
+        executor = self.get_executor()
+
+        def check_broken(future):
+            # a worker died (e.g. out of memory), start a fresh pool next time
+            if isinstance(future.exception(), BrokenProcessPool):
+                self.reset(executor)
+
+        try:
+            future = executor.submit(func, *args)
+        except BrokenProcessPool:
+            self.reset(executor)
+            raise
+        future.add_done_callback(check_broken)
+        return future
+
+    def predict(self, pdb, model):
+        return self.submit(predict, pdb, model).result()
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown()
+
+
+class SharedPredictions:
+    """Shares the pool prediction of a structure between concurrent requests
+
+    A request for a (model, structure) pair that is already being predicted
+    waits for that prediction instead of submitting its own. Each caller
+    gets its own copy of the result.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.inflight = {}
+        self.lock = Lock()
+
+    def predict(self, pdb, model):
+        with open(pdb, "rb") as f:
+            key = (model, hashlib.sha1(f.read()).hexdigest())
+
+        with self.lock:
+            future = self.inflight.get(key)
+            submitted = future is None
+            if submitted:
+                future = self.pool.submit(predict, pdb, model)
+                self.inflight[key] = future
+        if submitted:
+            # outside the lock, a finished future runs the callback right away
+            future.add_done_callback(functools.partial(self.forget, key))
+        return copy.deepcopy(future.result())
+
+    def forget(self, key, future):
+        with self.lock:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+
+
+PKAI_POOL = PkaiPool(PKAI_WORKERS, PKAI_THREADS)
+PKAI_PREDICTIONS = SharedPredictions(PKAI_POOL)
@@ -0,0 +1,279 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+PKPDB_FILES = (
+    "static/pkas.csv",
+    "static/isoelectric.csv",
+    "static/titrationcurves.csv",
+)
+
+# bumped whenever the snapshot layout changes
+SNAPSHOT_FORMAT = 2
+
+SNAPSHOT_COLUMNS = {
+    "pka_offsets": np.int64,
+    "chain": np.uint16,
+    "resname": np.uint16,
+    "resnumb": np.int32,
+    "pk": np.float64,
+    "pI": np.float64,
+    "tit_offsets": np.int64,
+    "tit_key": np.uint16,
+    "tit_value": np.float64,
+}
+
+
+def format_pk(pk):
+    # missing pKas are reported as "-"
+    return "-" if pk != pk else pk
+
+
+def format_pI(pI):
+    return None if pI != pI else pI
+
+
+class PkpdbStore:
+    """Read-only pKPDB lookup table keyed by idcode
+
+    Rows are sorted by (idcode, chain, residue_number) once at build time so
+    each protein is a contiguous slice of the pKa table. The values are the
+    same as the ones returned by PkpdbSnapshot.
+    """
+
+    def __init__(self, rows, index, pIs, titcurves, version):
+        self.rows = rows
+        self.index = index
+        self.pIs = pIs
+        self.titcurves = titcurves
+        self.version = version
+
+    def __contains__(self, idcode):
+        return idcode in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_pkas(self, idcode):
+        start, end = self.index[idcode]
+        return [
+            [chain, resname, int(resnumb), format_pk(float(pk))]
+            for chain, resname, resnumb, pk in self.rows[start:end].tolist()
+        ]
+
+    def get_pI(self, idcode):
+        pI = self.pIs.get(idcode)
+        return None if pI is None else format_pI(pI)
+
+    def get_titcurve(self, idcode):
+        return self.titcurves.get(idcode)
+
+
+def build_pkpdb_store(df_pkas, df_pI, df_titcurves, version=None):
+    df_pkas = df_pkas.sort_values(
+        ["idcode", "chain", "residue_number"], kind="mergesort"
+    )
+    df_pkas = df_pkas.assign(
+        chain=df_pkas["chain"].fillna("").astype(str),
+        residue_name=df_pkas["residue_name"].astype(str),
+        pk=pd.to_numeric(df_pkas["pk"], errors="coerce"),
+    )
+    rows = df_pkas[["chain", "residue_name", "residue_number", "pk"]].values
+
+    idcodes = df_pkas["idcode"].values
+    if len(idcodes):
+        starts = np.flatnonzero(np.r_[True, idcodes[1:] != idcodes[:-1]])
+    else:
+        starts = np.array([], dtype=int)
+    ends = np.r_[starts[1:], len(idcodes)]
+    index = {
+        idcodes[start]: (int(start), int(end)) for start, end in zip(starts, ends)
+    }
+
+    df_pI = df_pI.drop_duplicates("idcode")
+    pIs = dict(
+        zip(
+            df_pI["idcode"],
+            pd.to_numeric(df_pI.iloc[:, 2], errors="coerce").values.tolist(),
+        )
+    )
+
+    df_titcurves = df_titcurves.drop_duplicates("idcode")
+    titcurves = {
+        idcode: json.loads(tit_curve)
+        for idcode, tit_curve in zip(df_titcurves["idcode"], df_titcurves.iloc[:, 2])
+    }
+
+    return PkpdbStore(rows, index, pIs, titcurves, version)
+
+
+class PkpdbSnapshot:
+    """Memory-mapped columnar pKPDB snapshot written by write_pkpdb_snapshot
+
+    The arrays are opened read-only with mmap so every worker process shares
+    the same page cache copy.
+    """
+
+    def __init__(self, path):
+        with open(f"{path}/meta.json") as f:
+            meta = json.load(f)
+        self.version = meta["version"]
+        self.format = meta.get("format")
+        self.chains = meta["chains"]
+        self.resnames = meta["resnames"]
+        self.tit_keys = meta["tit_keys"]
+        self.index = {idcode: i for i, idcode in enumerate(meta["idcodes"])}
+
+        for column in SNAPSHOT_COLUMNS:
+            setattr(self, column, np.load(f"{path}/{column}.npy", mmap_mode="r"))
+
+    def __contains__(self, idcode):
+        return idcode in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_pkas(self, idcode):
+        i = self.index[idcode]
+        start, end = self.pka_offsets[i], self.pka_offsets[i + 1]
+        results = []
+        for chain, resname, resnumb, pk in zip(
+            self.chain[start:end].tolist(),
+            self.resname[start:end].tolist(),
+            self.resnumb[start:end].tolist(),
+            self.pk[start:end].tolist(),
+        ):
+            results.append(
+                [self.chains[chain], self.resnames[resname], resnumb, format_pk(pk)]
+            )
+        return results
+
+    def get_pI(self, idcode):
+        i = self.index.get(idcode)
+        if i is None:
+            return None
+        return format_pI(float(self.pI[i]))
+
+    def get_titcurve(self, idcode):
+        i = self.index.get(idcode)
+        if i is None:
+            return None
+        start, end = self.tit_offsets[i], self.tit_offsets[i + 1]
+        if start == end:
+            return None
+        return {
+            self.tit_keys[key]: value
+            for key, value in zip(
+                self.tit_key[start:end].tolist(), self.tit_value[start:end].tolist()
+            )
+        }
+
+
+def write_pkpdb_snapshot(df_pkas, df_pI, df_titcurves, path, version):
+    df_pkas = df_pkas.sort_values(
+        ["idcode", "chain", "residue_number"], kind="mergesort"
+    )
+    idcodes = df_pkas["idcode"].values
+    if len(idcodes):
+        starts = np.flatnonzero(np.r_[True, idcodes[1:] != idcodes[:-1]])
+    else:
+        starts = np.array([], dtype=int)
+    unique_idcodes = idcodes[starts].tolist()
+
+    chain_codes, chains = pd.factorize(df_pkas["chain"].fillna("").astype(str))
+    resname_codes, resnames = pd.factorize(df_pkas["residue_name"].astype(str))
+
+    df_pI = df_pI.drop_duplicates("idcode").set_index("idcode")
+    pIs = pd.to_numeric(
+        df_pI.iloc[:, 1].reindex(unique_idcodes), errors="coerce"
+    ).values
+
+    df_titcurves = df_titcurves.drop_duplicates("idcode").set_index("idcode")
+    titcurves = df_titcurves.iloc[:, 1].to_dict()
+    tit_keys = {}
+    tit_key, tit_value, tit_offsets = [], [], [0]
+    for idcode in unique_idcodes:
+        tit_curve = titcurves.get(idcode)
+        if isinstance(tit_curve, str):
+            for key, value in json.loads(tit_curve).items():
+                tit_key.append(tit_keys.setdefault(key, len(tit_keys)))
+                tit_value.append(value)
+        tit_offsets.append(len(tit_key))
+
+    columns = {
+        "pka_offsets": np.r_[starts, len(idcodes)],
+        "chain": chain_codes,
+        "resname": resname_codes,
+        "resnumb": df_pkas["residue_number"].values,
+        "pk": pd.to_numeric(df_pkas["pk"], errors="coerce").values,
+        "pI": pIs,
+        "tit_offsets": tit_offsets,
+        "tit_key": tit_key,
+        "tit_value": tit_value,
+    }
+    meta = {
+        "version": version,
+        "format": SNAPSHOT_FORMAT,
+        "idcodes": unique_idcodes,
+        "chains": chains.tolist(),
+        "resnames": resnames.tolist(),
+        "tit_keys": list(tit_keys),
+    }
+
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for column, dtype in SNAPSHOT_COLUMNS.items():
+        np.save(f"{tmp_path}/{column}.npy", np.asarray(columns[column], dtype=dtype))
+    with open(f"{tmp_path}/meta.json", "w") as f:
+        json.dump(meta, f)
+
+    # workers still mapping the old snapshot keep their unlinked files open
+    old_path = f"{path}.old"
+    if os.path.isdir(path):
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def load_static_files():
+    df_pkpdb_pkas = pd.read_csv("static/pkas.csv", header=0, sep=";")
+    df_pkpdb_pI = pd.read_csv("static/isoelectric.csv", header=0, sep=";")
+    df_pkpdb_titcurves = pd.read_csv("static/titrationcurves.csv", header=0, sep=";")
+    return df_pkpdb_pkas, df_pkpdb_pI, df_pkpdb_titcurves
+
+
+def get_static_files_version():
+    stamp = hashlib.sha1()
+    for fname in PKPDB_FILES:
+        fstat = os.stat(fname)
+        stamp.update(f"{fname}:{fstat.st_size}:{fstat.st_mtime_ns};".encode())
+    return stamp.hexdigest()[:16]
+
+
+def load_pkpdb_store(snapshot_path):
+    """Opens the snapshot unless it was built from other csv files"""
+    try:
+        version = get_static_files_version()
+    except FileNotFoundError:
+        # deployments may ship only the snapshot
+        version = None
+
+    if os.path.isdir(snapshot_path):
+        snapshot = PkpdbSnapshot(snapshot_path)
+        if snapshot.format == SNAPSHOT_FORMAT and (
+            version is None or snapshot.version == version
+        ):
+            return snapshot
+        logging.warning(
+            f"pKPDB snapshot {snapshot.version} at {snapshot_path} does not match "
+            f"the csv files ({version}) or format {SNAPSHOT_FORMAT}, loading the "
+            "csv files instead. Run `make pkpdb-snapshot` to rebuild it."
+        )
+    return build_pkpdb_store(*load_static_files(), version=version)
@@ -0,0 +1,71 @@
+import datetime
+import logging
+import traceback
+
+from database import DB_SESSION
+from models import Job, Protein, JobFingerprint
+from usage_stats import plus_one_pypka_subs
+from backends import get_backend
+from fingerprints import get_fingerprint, find_source_job, reuse_results
+from geolocation import locate_job
+from slurm import SlurmMonitor
+
+
+def submit_pypka_job(job_params, sub_params, subID):
+    plus_one_pypka_subs()
+
+    pdbid, pdbfile, outputemail, nsites, nchains, ip = sub_params
+    cur_date = datetime.datetime.today()
+    new_job = Job(
+        dat_time=cur_date,
+        email=outputemail,
+        sub_id=subID,
+        ip=ip,
+    )
+    DB_SESSION.add(new_job)
+    DB_SESSION.commit()
+    job_id = new_job.job_id
+    locate_job(job_id, ip)
+
+    pid = None
+    try:
+        if pdbid:
+            pid = (
+                DB_SESSION.query(Protein.protein_id)
+                .filter(Protein.pdb_code == pdbid)
+                .first()
+            )
+        else:
+            pdbid = f"#{job_id}"
+        if pid:
+            pid = pid[0]
+        else:
+            new_protein = Protein(
+                pdb_code=pdbid, pdb_file=pdbfile, nsites=nsites, nchains=nchains
+            )
+            DB_SESSION.add(new_protein)
+            DB_SESSION.commit()
+            pid = new_protein.protein_id
+
+        fingerprint = get_fingerprint(job_params)
+        source_job_id = find_source_job(DB_SESSION, fingerprint)
+        if source_job_id:
+            reuse_results(
+                DB_SESSION, source_job_id, fingerprint, job_params, subID, job_id, pid
+            )
+            DB_SESSION.close()
+            return
+        DB_SESSION.add(JobFingerprint(job_id=job_id, fingerprint=fingerprint))
+        DB_SESSION.commit()
+
+        DB_SESSION.close()
+        backend = get_backend(job_params, nsites)
+        logging.info(f"{subID} submitted to the {backend.name} backend")
+        backend.submit(job_params, subID, job_id, pid, nsites, nchains)
+    except Exception:
+        # also reached on a dispatch timeout, the job must not stay submitted
+        logging.error(f"{subID} dispatch failed\n{traceback.format_exc()}")
+        DB_SESSION.rollback()
+        DB_SESSION.remove()
+        SlurmMonitor.finish(subID, job_id, pid, "Job could not be submitted")
+        raise
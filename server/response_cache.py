@@ -0,0 +1,38 @@
+import hashlib
+
+from flask import request, Response
+
+from cache import LRUCache
+from const import CONFIG
+
+RESPONSE_CACHE = LRUCache(int(CONFIG.get("RESPONSE_CACHE_SIZE") or 4096))
+RESPONSE_MAX_AGE = int(CONFIG.get("RESPONSE_CACHE_MAX_AGE") or 86400)
+
+
+def cached_response(key, build_body, mimetype="application/json", private=False):
+    """Serves an immutable response identified by key
+
+    The ETag is derived from the key alone, so conditional requests are
+    answered with a 304 without building or even looking up the body.
+    build_body must return the serialized bytes and is called only on a
+    cache miss. private responses (e.g. whole user files) may only be
+    stored by the client, their body is built on every full request.
+    """
+    etag = hashlib.sha1(repr(key).encode()).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif private:
+        response = Response(build_body(), mimetype=mimetype)
+    else:
+        body = RESPONSE_CACHE.get(key)
+        if body is None:
+            body = build_body()
+            RESPONSE_CACHE.set(key, body)
+        response = Response(body, mimetype=mimetype)
+
+    response.set_etag(etag)
+    scope = "private" if private else "public"
+    response.headers["Cache-Control"] = f"{scope}, max-age={RESPONSE_MAX_AGE}"
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
@@ -1,10 +1,18 @@
 import os
+import time
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, Request
 from sse_starlette.sse import EventSourceResponse
 from fastapi.middleware.cors import CORSMiddleware
-import subprocess
-from database import DB_SESSION
+from sqlalchemy import case, func, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from database import DB_SESSION, db_path
+from job_events import JobEventListener
+from log_tail import LogTail
+from slurm_queue import QueueSnapshot
+from cache import LRUCache
+from const import CONFIG
 from models import Job, Results, Residue, Pk, Input, Protein
 from pprint import pformat
 import json
@@ -30,189 +38,267 @@ app.add_middleware(
 
 
 STREAM_DELAY = 1  # second
+# fallback re-check in case a job event was missed
+IDLE_RECHECK_DELAY = int(CONFIG.get("STREAM_IDLE_RECHECK") or 60)  # seconds
 
-DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+# final messages of finished jobs, already serialized
+FINAL_MESSAGES = LRUCache(int(CONFIG.get("STREAM_FINAL_CACHE_SIZE") or 256))
+# ms, the stream is closed after the final message so reconnects are delayed
+FINAL_RETRY = 60000
 
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 
-@app.get("/")
-async def home():
-    return {"message": "ALIVE!"}
+# sized like the engine pool so no thread waits for a connection
+DB_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(CONFIG.get("STREAM_DB_WORKERS") or 3),
+    thread_name_prefix="results-db",
+)
 
+JOB_EVENTS = JobEventListener(db_path)
+SLURM_QUEUE = QueueSnapshot(
+    CONFIG["SID"], float(CONFIG.get("STREAM_QUEUE_INTERVAL") or 2)
+)
 
-@app.get("/stream")
-async def message_stream(request: Request, subID: str):
-    """Stream subID log"""
 
-    def check_logs(subID):
-        # subID = str(subID)
-        print(f"RECEIVED {subID}")
+@app.on_event("startup")
+async def start_job_events():
+    await JOB_EVENTS.start()
+    SLURM_QUEUE.start()
 
-        with DB_SESSION() as session:
-            print(f"STARTED {subID}")
-            job_id = session.query(Job.job_id).filter_by(sub_id=subID).first()
 
-            sbrun = subprocess.run(
-                f"s-id pedror | grep {subID} | wc -l", shell=True, capture_output=True
-            )
-            in_queue = int(sbrun.stdout.decode("utf-8").strip())
-            print(job_id, in_queue, job_id and not in_queue)
-            if job_id and not in_queue:
-                job_id = job_id[0]
-
-                tit_x, tit_y, pI = None, None, None
-                pKas = []
-                pdb_out = None
-                nchains, nsites = None, None
-
-                results = (
-                    session.query(
-                        Results.tit_curve,
-                        Results.isoelectric_point,
-                        Results.pdb_out,
-                        Results.pdb_out_ph,
-                        Results.error,
-                    )
-                    .filter(Results.job_id == job_id)
-                    .first()
-                )
-
-                protein = (
-                    session.query(
-                        Protein.nchains,
-                        Protein.nsites,
-                        Protein.pdb_code,
-                        Protein.pdb_file,
-                    )
-                    .join(Input, Input.protein_id == Protein.protein_id)
-                    .filter(Input.job_id == job_id)
-                    .first()
-                )
+@app.get("/")
+async def home():
+    return {"message": "ALIVE!"}
 
-                params = (
-                    session.query(Input.mc_set, Input.pb_set, Input.pypka_set)
-                    .filter(Input.job_id == job_id)
-                    .first()
-                )
 
-                print(results)
+def check_logs(subID):
+    """Returns the final message of a finished job or None
 
-                if results:
-                    tit_curve, pI, pdb_out, pdb_out_ph, error = results
-                    nchains, nsites, protein_name, pdb_file = protein
+    Everything is fetched in one joined query, the pKas are aggregated by
+    Postgres and the stored pdb files are only reported as flags, without
+    being transferred or decompressed.
+    """
+    if SLURM_QUEUE.is_queued(subID):
+        return None
 
-                    if error:
-                        return {
-                            "content": {"failed": True, "log": error},
-                            "subID": subID,
-                            "nsites": nsites,
-                            "nchains": nchains,
-                            "status": "success",
-                            "protein_name": protein_name,
-                            "protein_pdb": pdb_file,
-                        }
+    pks = (
+        select(
+            func.json_agg(
+                aggregate_order_by(
+                    func.json_build_array(
+                        Residue.chain, Residue.res_name, Residue.res_number, Pk.pk
+                    ),
+                    Residue.chain,
+                    Residue.res_number,
+                    Residue.res_name,
+                )
+            )
+        )
+        .where(Residue.res_id == Pk.res_id)
+        .where(Pk.job_id == Job.job_id)
+        .scalar_subquery()
+    )
 
-                    (tit_x, tit_y) = tit_curve
+    with DB_SESSION() as session:
+        row = (
+            session.query(
+                Results.tit_curve,
+                Results.isoelectric_point,
+                Results.pdb_out.isnot(None),
+                Results.pdb_out_ph,
+                Results.error,
+                Protein.nchains,
+                Protein.nsites,
+                Protein.pdb_code,
+                Protein.pdb_file.isnot(None),
+                case((Results.error.isnot(None), Protein.pdb_file)),
+                Input.mc_set,
+                Input.pb_set,
+                Input.pypka_set,
+                pks,
+            )
+            .select_from(Job)
+            .outerjoin(Results, Results.job_id == Job.job_id)
+            .outerjoin(Input, Input.job_id == Job.job_id)
+            .outerjoin(Protein, Protein.protein_id == Input.protein_id)
+            .filter(Job.sub_id == subID)
+            .first()
+        )
+
+    if not row or row.tit_curve is None and not row.error:
+        return None
+
+    (
+        tit_curve,
+        pI,
+        pdb_out,
+        pdb_out_ph,
+        error,
+        nchains,
+        nsites,
+        protein_name,
+        original_pdb,
+        pdb_file,
+        mc_set,
+        pb_set,
+        pypka_set,
+        pks,
+    ) = row
+
+    if error:
+        return {
+            "content": {"failed": True, "log": error},
+            "subID": subID,
+            "nsites": nsites,
+            "nchains": nchains,
+            "status": "success",
+            "protein_name": protein_name,
+            "protein_pdb": pdb_file,
+        }
 
-                    mc_set, pb_set, pypka_set = params
+    tit_x, tit_y = tit_curve
+    pKas = []
+    for chain, resname, resnumb, pka in pks or []:
+        pKas.append((chain, resname, resnumb, round(pka, 2) if pka else "-"))
+
+    if not (tit_x and tit_y and pKas and pI):
+        return None
+
+    return {
+        "content": {
+            "tit_x": tit_x,
+            "tit_y": tit_y,
+            "pKas": pKas,
+            "pI": pI,
+            "nsites": nsites,
+            "nchains": nchains,
+            "pHmin": mc_set["pHmin"],
+            "pHmax": mc_set["pHmax"],
+            "ionicStrength": pb_set["ionicstr"],
+            "proteinDielectric": pb_set["epsin"],
+            "solventDielectric": pb_set["epssol"],
+            "params": pformat({**pypka_set, **pb_set, **mc_set}),
+            "pdb_out": bool(pdb_out),
+            "outputFilepH": pdb_out_ph,
+            "protein_name": protein_name,
+            "original_pdb": bool(original_pdb),
+        },
+        "subID": subID,
+        "status": "success",
+    }
+
+
+async def load_results(subID):
+    # runs off the event loop so a slow query only holds its own stream
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, check_logs, subID)
+
+
+def get_logpath(subID):
+    return f"{DIR_PATH}/submissions/{subID}.out"
+
+
+def get_final_event(data):
+    return {
+        "event": "new_message",
+        "id": "message_id",
+        "data": data,
+        "retry": FINAL_RETRY,
+    }
+
+
+async def load_final_message(subID):
+    """Returns the serialized final message of a finished job or None"""
+    data = FINAL_MESSAGES.get(subID)
+    if data is None:
+        message = await load_results(subID)
+        if message:
+            data = json.dumps(message)
+            FINAL_MESSAGES.set(subID, data)
+    return data
 
-                    pHmin, pHmax = mc_set["pHmin"], mc_set["pHmax"]
-                    ionicstr, epssol, epsin = (
-                        pb_set["ionicstr"],
-                        pb_set["epssol"],
-                        pb_set["epsin"],
-                    )
 
-                    all_params = pformat({**pypka_set, **pb_set, **mc_set})
+@app.get("/stream")
+async def message_stream(request: Request, subID: str):
+    """Stream subID log
 
-                pks = (
-                    session.query(
-                        Residue.chain, Residue.res_name, Residue.res_number, Pk.pk
-                    )
-                    .filter(Residue.res_id == Pk.res_id)
-                    .filter(Pk.job_id == job_id)
-                    .order_by(Residue.chain, Residue.res_number, Residue.res_name)
-                    .all()
-                )
+    The first event carries the whole log ("new_message"), then only the
+    appended lines are sent ("log_delta"). A reconnecting client whose
+    Last-Event-ID still fits the log resumes from there without a resync.
+    The stream closes after sending the final message once.
+    """
 
-                if pks:
-                    for pk in pks:
-                        chain, resname, resnumb, pka = pk
-                        if pka:
-                            pka = round(pka, 2)
-                        else:
-                            pka = "-"
-                        pKas.append((chain, resname, resnumb, pka))
-
-                if tit_x and tit_y and pKas and pI and not error:
-                    response_dict = {
-                        "tit_x": tit_x,
-                        "tit_y": tit_y,
-                        "pKas": pKas,
-                        "pI": pI,
-                        "nsites": nsites,
-                        "nchains": nchains,
-                        "pHmin": pHmin,
-                        "pHmax": pHmax,
-                        "ionicStrength": ionicstr,
-                        "proteinDielectric": epsin,
-                        "solventDielectric": epssol,
-                        "params": all_params,
-                        "pdb_out": True if pdb_out else False,
-                        "outputFilepH": pdb_out_ph,
-                        "protein_name": protein_name,
-                        "original_pdb": True if pdb_file else False,
+    async def event_generator(subID):
+        final = FINAL_MESSAGES.get(subID)
+        if final is not None:
+            yield get_final_event(final)
+            return
+
+        events = JOB_EVENTS.subscribe(subID)
+        logpath = get_logpath(subID)
+        tail = LogTail.from_event_id(logpath, request.headers.get("last-event-id"))
+        resync = tail is None
+        if resync:
+            tail = LogTail(logpath)
+
+        try:
+            final = await load_final_message(subID)
+            last_check = time.monotonic()
+            started = ended = False
+            while final is None:
+                # If client closes connection, stop sending events
+                if await request.is_disconnected():
+                    return
+
+                replace_last, lines = tail.read()
+                if resync:
+                    resync = False
+                    yield {
+                        "event": "new_message",
+                        "id": tail.event_id,
+                        "data": json.dumps(
+                            {
+                                "content": "\n".join(lines) if lines else None,
+                                "subID": subID,
+                                "status": "running",
+                            }
+                        ),
                     }
-
-                    return {
-                        "content": response_dict,
-                        "subID": subID,
-                        "status": "success",
+                elif lines:
+                    yield {
+                        "event": "log_delta",
+                        "id": tail.event_id,
+                        "data": json.dumps(
+                            {
+                                "subID": subID,
+                                "status": "running",
+                                "replace_last": replace_last,
+                                "lines": lines,
+                            }
+                        ),
                     }
 
-        logpath = f"{DIR_PATH}/submissions/{subID}.out"
-        # logpath = f"/tmp/tmp_{subID}/LOG_{subID}"
-        print("showing", logpath)
-
-        content = []
-        if os.path.isfile(logpath):
-            with open(logpath) as f:
-                lines = f.readlines()
-                for line in lines:
-                    line = line.strip()
-                    if line.startswith("PB Runs"):
-                        if content[-1].startswith("PB Runs"):
-                            content[-1] = line
-                        else:
-                            content.append(line)
-                    elif line.startswith("MC Run"):
-                        if content[-1].startswith("MC Run"):
-                            content[-1] = line
-                        else:
-                            content.append(line)
-                    else:
-                        content.append(line)
-                content = "\n".join(content)
-
-        return {
-            "content": content if content else None,
-            "subID": subID,
-            "status": "running",
-        }
-
-    async def event_generator(subID):
-        while True:
-            # If client closes connection, stop sending events
-            if await request.is_disconnected():
-                break
-
-            # Checks for new messages and return them to client if any
-            yield {
-                "event": "new_message",
-                "id": "message_id",
-                "data": json.dumps(check_logs(subID)),
-            }
-
-            await asyncio.sleep(STREAM_DELAY)
+                # a job with a log is running and its log is streamed, otherwise
+                # nothing happens until the job publishes a state change. An
+                # ended job is rechecked every STREAM_DELAY since its process
+                # may still be in the SLURM queue for a moment
+                running = started or ended or tail.offset > 0
+                try:
+                    state = await asyncio.wait_for(
+                        events.get(), STREAM_DELAY if running else IDLE_RECHECK_DELAY
+                    )
+                except asyncio.TimeoutError:
+                    state = None
+                started = started or state == "started"
+                ended = ended or state in ("finished", "failed")
+
+                if ended or time.monotonic() - last_check >= IDLE_RECHECK_DELAY:
+                    final = await load_final_message(subID)
+                    last_check = time.monotonic()
+        finally:
+            JOB_EVENTS.unsubscribe(subID, events)
+
+        yield get_final_event(final)
 
     return EventSourceResponse(
         event_generator(subID), headers={"Cache-Control": "public, max-age=29"}
@@ -1,26 +1,45 @@
+import datetime
 import json
-import requests
+import logging
+import re
 from pprint import pformat
 
-from flask import jsonify, request, Blueprint
+import requests
+from flask import jsonify, request, Blueprint, Response, stream_with_context
 
 from database import DB_SESSION
-from models import UsageStats
-from const import PKPDB_PARAMS, STATUS, DIR_PATH
-from utils import (
+from models import UsageStats, Job, Input, Protein, Results
+from usage_stats import (
+    USAGE_COUNTER,
+    COUNTERS,
+    get_recent_usage,
     plus_one_pkpdb_queries,
     plus_one_pkai_subs,
-    run_pKAI,
-    get_subID,
-    save_pdb,
-    df_pkpdb_pkas,
-    df_pkpdb_pI,
-    df_pkpdb_titcurves,
 )
+from const import PKPDB_PARAMS, STATUS, DIR_PATH, CONFIG
+from response_cache import cached_response
+from downloads import fetch_structure, structure_url
+from submission_queue import get_queue_stats
+from utils import run_pKAI, get_subID, save_pdb, PKPDB_STORE
 
 direct_routes_bp = Blueprint("direct_routes", __name__)
 direct_routes_severelimit_bp = Blueprint("direct_routes_severelimit", __name__)
 
+BULK_MAX_IDCODES = int(CONFIG.get("BULK_MAX_IDCODES") or 100000)
+
+
+def get_pkpdb_entry(idcode):
+    # some entries have no titration curve or pI
+    tit_curve = PKPDB_STORE.get_titcurve(idcode) or {}
+    return {
+        "idcode": idcode.upper(),
+        "method": "PypKa (pKPDB)",
+        "pdb": f"https://files.rcsb.org/download/{idcode}.pdb",
+        "pI": PKPDB_STORE.get_pI(idcode),
+        "pKas": PKPDB_STORE.get_pkas(idcode),
+        "tit_curve": {key: round(value, 2) for key, value in tit_curve.items()},
+    }
+
 
 @direct_routes_bp.route("/stats")
 def get_stats():
@@ -28,14 +47,29 @@ def get_stats():
         UsageStats.pkpdb_queries,
         UsageStats.pkpdb_downloads,
         UsageStats.pypka_subs,
-        UsageStats.pKAI_subs,
+        UsageStats.pkai_subs,
     ).first()
+    # counts from this process that have not been flushed yet
+    pending = USAGE_COUNTER.get_pending()
+    stats = [
+        stat + pending.get(counter, 0) for stat, counter in zip(stats, COUNTERS)
+    ]
+
+    last_hour = get_recent_usage(
+        DB_SESSION, datetime.datetime.now() - datetime.timedelta(hours=1)
+    )
 
     response_dict = {
         "pKPDB Queries": stats[0],
         "pKPDB Downloads": stats[1],
         "PypKa Jobs": stats[2],
         "pKAI Jobs": stats[3],
+        "Last hour": {
+            "pKPDB Queries": last_hour.get("pkpdb_queries", 0),
+            "pKPDB Downloads": last_hour.get("pkpdb_downloads", 0),
+            "PypKa Jobs": last_hour.get("pypka_subs", 0),
+            "pKAI Jobs": last_hour.get("pkai_subs", 0),
+        },
     }
 
     response = jsonify(response_dict)
@@ -65,6 +99,9 @@ def hello():
 
         /pKAI/<idcode>     GET/POST    Runs a pKAI calculation
                            Example: https://api.pypka.org/pkpdb/4LZT
+
+        /pkas/bulk         POST        Streams pKPDB results for many idcodes as NDJSON
+                           Body: {"idcodes": ["4LZT", "1A2P"]} or a "file" upload
         """,
         }
     )
@@ -79,42 +116,30 @@ def pkpdb_query(idcode):
 
     idcode = idcode.lower()
 
-    df_protein_results = df_pkpdb_pkas.query(f"idcode == '{idcode}'").sort_values(
-        ["chain", "residue_number"]
-    )
-    if len(df_protein_results) > 0:
-        results_list = df_protein_results[
-            ["chain", "residue_name", "residue_number", "pk"]
-        ].values.tolist()
+    def build_body():
+        if idcode in PKPDB_STORE:
+            tit_curve = PKPDB_STORE.get_titcurve(idcode) or {}
+            tit_x, tit_y = list(tit_curve.keys()), list(tit_curve.values())
 
-        tit_curve = json.loads(
-            df_pkpdb_titcurves.query(f"idcode == '{idcode}'").values.tolist()[0][2]
-        )
-        tit_x, tit_y = list(tit_curve.keys()), list(tit_curve.values())
+            response_dict = {
+                "tit_x": tit_x,
+                "tit_y": tit_y,
+                "pI": PKPDB_STORE.get_pI(idcode),
+                "pKas": PKPDB_STORE.get_pkas(idcode),
+                "params": pformat(PKPDB_PARAMS),
+            }
 
-        response_dict = {
-            "tit_x": tit_x,
-            "tit_y": tit_y,
-            "pI": df_pkpdb_pI.query(f"idcode == '{idcode}'").values.tolist()[0][2],
-            "pKas": results_list,
-            "params": pformat(PKPDB_PARAMS),
-        }
+        else:
+            response_dict = {}
 
-    else:
-        response_dict = {}
+        return jsonify(response_dict).get_data()
 
-    response = jsonify(response_dict)
-    response.headers.add("Access-Control-Allow-Origin", "*")
-    return response
+    return cached_response(("query", idcode, PKPDB_STORE.version), build_body)
 
 
 @direct_routes_severelimit_bp.route("/pkpdb/<idcode>", methods=["GET", "POST"])
 def exists_on_pkpdb(idcode):
-    results = df_pkpdb_pkas.query(f"idcode == '{idcode.lower()}'")
-    if len(results) > 0:
-        results = True
-    else:
-        results = False
+    results = idcode.lower() in PKPDB_STORE
     response = jsonify(results)
     response.headers.add("Access-Control-Allow-Origin", "*")
     return response
@@ -125,15 +150,20 @@ def run_pKAI_idcode(idcode):
     plus_one_pkai_subs()
     subID = get_subID(request)
 
-    r = requests.get(f"https://files.rcsb.org/download/{idcode}.pdb")
-    pdb_content = r.content.decode("utf-8")
-    if "The requested URL was not found on this server." in pdb_content:
-        results = f"Error: {idcode} not found"
+    try:
+        pdb_content = fetch_structure(idcode, source="rcsb")
+    except requests.RequestException as e:
+        logging.error(f"{idcode} download failed: {e}")
+        results = f"Error: {idcode} could not be downloaded"
 
     else:
-        newfilename = save_pdb(pdb_content, subID)
+        if pdb_content is None:
+            results = f"Error: {idcode} not found"
 
-        results = run_pKAI(newfilename, "pKAI")
+        else:
+            newfilename = save_pdb(pdb_content, subID)
+
+            results = run_pKAI(newfilename, "pKAI")
 
     response = jsonify(results)
     response.headers.add("Access-Control-Allow-Origin", "*")
@@ -145,42 +175,19 @@ def get_pkas_from_idcode(idcode):
     idcode = idcode.lower()
     subID = get_subID(request)
 
-    df_protein_results = df_pkpdb_pkas.query(f"idcode == '{idcode}'").sort_values(
-        ["chain", "residue_number"]
-    )
-    if len(df_protein_results) > 0:
-        results_list = df_protein_results[
-            ["chain", "residue_name", "residue_number", "pk"]
-        ].values.tolist()
-        response_dict = {
-            "idcode": idcode.upper(),
-            "method": "PypKa (pKPDB)",
-            "pdb": f"https://files.rcsb.org/download/{idcode}.pdb",
-            "pI": df_pkpdb_pI.query(f"idcode == '{idcode}'").values.tolist()[0][2],
-            "pKas": results_list,
-            "tit_curve": {
-                key: round(value, 2)
-                for key, value in json.loads(
-                    df_pkpdb_titcurves.query(f"idcode == '{idcode}'").values.tolist()[
-                        0
-                    ][2]
-                ).items()
-            },
-        }
-        return jsonify(response_dict)
-
-    # PDB IDCODE
-    if len(idcode) == 4:
-        r = requests.get(f"https://files.rcsb.org/download/{idcode}.pdb")
-        pdb_content = r.content.decode("utf-8")
-    else:
-        idcode_upper = idcode.upper()
-        r = requests.get(
-            f"https://alphafold.ebi.ac.uk/files/AF-{idcode_upper}-F1-model_v4.pdb"
+    if idcode in PKPDB_STORE:
+        return cached_response(
+            ("pkas", idcode, PKPDB_STORE.version),
+            lambda: jsonify(get_pkpdb_entry(idcode)).get_data(),
         )
-        pdb_content = r.content.decode("utf-8")
 
-    if "ATOM " not in pdb_content:
+    # PDB IDCODE if 4 characters long, AlphaFold DB otherwise
+    try:
+        pdb_content = fetch_structure(idcode)
+    except requests.RequestException as e:
+        logging.error(f"{idcode} download failed: {e}")
+        return f"Error: {idcode} could not be downloaded"
+    if pdb_content is None:
         return f"Error: {idcode} not found"
 
     newfilename = save_pdb(pdb_content, subID)
@@ -191,7 +198,7 @@ def get_pkas_from_idcode(idcode):
         response_dict = {
             "idcode": idcode.upper(),
             "method": "pKAI 1.2.0",
-            "pdb": f"https://alphafold.ebi.ac.uk/files/AF-{idcode_upper}-F1-model_v4.pdb",
+            "pdb": structure_url(idcode),
             **results,
             "tit_curve": {x: y for x, y in zip(results["tit_x"], results["tit_y"])},
         }
@@ -206,28 +213,93 @@ def get_pkas_from_idcode(idcode):
     return response
 
 
+@direct_routes_severelimit_bp.route("/pkas/bulk", methods=["POST"])
+def get_pkas_bulk():
+    if "file" in request.files:
+        idcodes = request.files["file"].read().decode("utf-8")
+    else:
+        body = request.get_json(silent=True) or {}
+        idcodes = body.get("idcodes", []) if isinstance(body, dict) else None
+    if isinstance(idcodes, str):
+        idcodes = re.split(r"[\s,;]+", idcodes)
+    if isinstance(idcodes, list):
+        idcodes = list(dict.fromkeys(str(i).strip().lower() for i in idcodes if i))
+
+    if not isinstance(idcodes, list) or not idcodes or len(idcodes) > BULK_MAX_IDCODES:
+        response = jsonify(
+            {"Error": f"Provide between 1 and {BULK_MAX_IDCODES} idcodes"}
+        )
+        response.status_code = 400
+        response.headers.add("Access-Control-Allow-Origin", "*")
+        return response
+
+    USAGE_COUNTER.add("pkpdb_queries", len(idcodes))
+
+    def generate():
+        for idcode in idcodes:
+            if idcode not in PKPDB_STORE:
+                entry = {"idcode": idcode.upper(), "Error": "not found"}
+            else:
+                # a broken entry must not cut the stream for the others
+                try:
+                    entry = get_pkpdb_entry(idcode)
+                    del entry["method"]
+                    del entry["pdb"]
+                except Exception as e:
+                    logging.error(f"pKPDB entry {idcode}: {e}")
+                    entry = {"idcode": idcode.upper(), "Error": str(e)}
+            yield json.dumps(entry, separators=(",", ":")) + "\n"
+
+    response = Response(
+        stream_with_context(generate()), mimetype="application/x-ndjson"
+    )
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
+
+
 @direct_routes_bp.route("/queue-size")
 def get_queue_size():
-    # response = jsonify(len(job_queue))
-    response = jsonify(0)
+    response = jsonify(get_queue_stats())
     response.headers.add("Access-Control-Allow-Origin", "*")
     return response
 
 
+def load_file_from_db(subID, ftype):
+    if ftype == "original_pdb":
+        query = DB_SESSION.query(Protein.pdb_file).join(
+            Input, Input.protein_id == Protein.protein_id
+        )
+        query = query.join(Job, Job.job_id == Input.job_id)
+    else:
+        query = DB_SESSION.query(Results.pdb_out).join(
+            Job, Job.job_id == Results.job_id
+        )
+    row = query.filter(Job.sub_id == subID).first()
+    return row[0] if row else None
+
+
 @direct_routes_severelimit_bp.route("/getFile", methods=["GET", "POST"])
 def get_file():
-    subID = request.json["subID"]
-    ftype = request.json["file_type"]
+    params = request.get_json(silent=True) or request.args
+    subID = params["subID"]
+    ftype = params["file_type"]
 
     if ftype == "original_pdb":
         fname = f"{DIR_PATH}/pdbs/{subID}.pdb"
     elif ftype == "pdb_out":
         fname = f"{DIR_PATH}/pdbs_out/out_{subID}.pdb"
 
-    with open(fname) as f:
-        content = f.read()
-
-    response = jsonify(content)
-    response.headers.add("Access-Control-Allow-Origin", "*")
-
-    return response
+    def build_body():
+        try:
+            with open(fname) as f:
+                content = f.read()
+        except FileNotFoundError:
+            # the stored copy is decompressed only when the file is gone
+            content = load_file_from_db(subID, ftype)
+            if content is None:
+                raise
+        return jsonify(content).get_data()
+
+    # files of a submission never change once they have been written, but
+    # they belong to the submitter and must not be kept by shared caches
+    return cached_response(("file", subID, ftype), build_body, private=True)
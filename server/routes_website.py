@@ -1,8 +1,6 @@
 import logging
 import os
 import traceback
-import requests
-from threading import Thread
 from pprint import pformat
 
 from flask import jsonify, request, Blueprint
@@ -11,10 +9,12 @@ from pypka.main import getTitrableSites
 
 from pka2pI import pkas_2_pdb, clean_pdb
 from database import DB_SESSION
-from models import Job, Protein, Input, Results
+from models import Job, Protein, Input
 from const import PKPDB_PARAMS, DIR_PATH, CONFIG
+from cache import LRUCache
 from routes_direct import pkpdb_query, save_pdb
-from utils import submit_pypka_job, get_subID, run_pKAI
+from utils import get_subID, run_pKAI
+from submission_queue import enqueue_submission, get_queue_stats, QueueFull
 
 routes_bp = Blueprint("routes", __name__)
 
@@ -62,11 +62,8 @@ def getSubID():
 
 @routes_bp.route("/submitSim", methods=["POST"])
 def submitCalculation():
-    # Get IP, country, and city information
+    # country and city are resolved in the background once the job exists
     ip = request.remote_addr
-    location_info = requests.get(f"https://ipinfo.io/{ip}/json").json()
-    country = location_info.get("country", "Unknown")
-    city = location_info.get("city", "Unknown")
 
     pdbfile = request.json["pdbfile"]
     pdbid = request.json["pdbcode"]
@@ -107,7 +104,7 @@ def submitCalculation():
 
     if model in ("pKAI", "pKAI+"):
         tmp_f = f"{DIR_PATH}/pdbs/{subID}_cleaned.pdb"
-        clean_pdb(newfilename, tmp_f)
+        structure = clean_pdb(newfilename, tmp_f)
         newfilename = tmp_f
 
         results = run_pKAI(newfilename, model)
@@ -115,7 +112,7 @@ def submitCalculation():
         if outputfile:
             pkas_2_pdb(
                 subID,
-                newfilename,
+                structure,
                 f"{DIR_PATH}/pdbs_out/out_{subID}.pdb",
                 outputfilepH,
                 outputfilenaming,
@@ -164,18 +161,19 @@ def submitCalculation():
             nsites,
             nchains,
             ip,
-            country,
-            city,
         )
 
-        Thread(
-            target=submit_pypka_job,
-            args=(
-                parameters,
-                sub_parameters,
-                subID,
-            ),
-        ).start()
+        try:
+            enqueue_submission(parameters, sub_parameters, subID)
+        except QueueFull:
+            stats = get_queue_stats()
+            response = jsonify(
+                {"error": "The submission queue is full, please try again later"}
+            )
+            response.status_code = 503
+            response.headers.add("Retry-After", str(int(stats["dispatch_wait"]) + 1))
+            response.headers.add("Access-Control-Allow-Origin", "*")
+            return response
 
         response = jsonify({"subID": subID})
         response.headers.add("Access-Control-Allow-Origin", "*")
@@ -183,35 +181,81 @@ def submitCalculation():
         return response
 
 
-@routes_bp.route("/getSubmissions", methods=["POST", "GET"])
-def get_submission():
-    submission_IDS = (
+SUBMISSIONS_PAGE_SIZE = 25
+SUBMISSIONS_MAX_PAGE_SIZE = 200
+# job.status values listed under each public status
+SUBMISSION_STATUSES = {
+    "queued": ("submitted", "queued"),
+    "running": ("running",),
+    "finished": ("finished", "failed"),
+}
+SUBMISSIONS_CACHE = LRUCache(
+    maxsize=8, ttl=float(CONFIG.get("SUBMISSIONS_CACHE_TTL") or 5)
+)
+
+
+def get_submissions_page(statuses, before=None, limit=SUBMISSIONS_PAGE_SIZE):
+    """Jobs with one of statuses, newest first, with job_id lower than before"""
+    query = (
         DB_SESSION.query(Job.job_id, Job.dat_time, Protein.pdb_code, Job.sub_id)
-        .join(Input, Input.protein_id == Protein.protein_id)
-        .filter(Input.job_id == Job.job_id)
-        .order_by(Job.sub_id.desc())
-        .limit(25)
-        .all()
+        .outerjoin(Input, Input.job_id == Job.job_id)
+        .outerjoin(Protein, Protein.protein_id == Input.protein_id)
+        .filter(Job.status.in_(statuses))
     )
-    sub_ids = [i[:] for i in submission_IDS]
+    if before is not None:
+        query = query.filter(Job.job_id < before)
+    return query.order_by(Job.job_id.desc()).limit(limit).all()
 
-    # queued = []
-    # sbrun = subprocess.run(f"s-id pedror | grep slurm_", shell=True, capture_output=True)
-    # slurm_queue = sbrun.stdout.decode("utf-8").strip()
-    # for line in slurm_queue.splitlines():
-    #    subID = line.split()[-1].replace('.py', '').replace('slurm_', '')
-    #    queued.append(subID)
 
-    finished = DB_SESSION.query(Results.job_id)
+def get_cached_page(status):
+    page = SUBMISSIONS_CACHE.get(status)
+    if page is None:
+        page = get_submissions_page(SUBMISSION_STATUSES[status])
+        page = [tuple(job) for job in page]
+        SUBMISSIONS_CACHE.set(status, page)
+    return page
 
-    inprogress_IDS = (
-        DB_SESSION.query(Job.job_id, Job.dat_time, Job.sub_id)
-        .filter(Job.job_id.not_in(finished))
-        .all()
-    )
-    queued_ids = [i[:2] + ("QUEUED", i[2]) for i in inprogress_IDS][::-1]
 
-    response = jsonify(queued_ids + sub_ids)
+@routes_bp.route("/getSubmissions", methods=["POST", "GET"])
+def get_submission():
+    in_progress = get_cached_page("queued") + get_cached_page("running")
+    in_progress.sort(reverse=True)
+    queued_ids = [
+        (job_id, dat_time, "QUEUED", sub_id)
+        for job_id, dat_time, _, sub_id in in_progress
+    ]
+
+    response = jsonify(queued_ids + get_cached_page("finished"))
+    response.headers.add("Access-Control-Allow-Origin", "*")
+
+    return response
+
+
+@routes_bp.route("/submissions/<status>", methods=["GET"])
+def get_submissions(status):
+    """Keyset-paginated submissions, pass the returned cursor as `before`"""
+    if status not in SUBMISSION_STATUSES:
+        response = jsonify({"error": f"Unknown status {status}"})
+        response.status_code = 404
+        response.headers.add("Access-Control-Allow-Origin", "*")
+        return response
+
+    before = request.args.get("before", type=int)
+    limit = request.args.get("limit", SUBMISSIONS_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, SUBMISSIONS_MAX_PAGE_SIZE))
+
+    if before is None and limit == SUBMISSIONS_PAGE_SIZE:
+        page = get_cached_page(status)
+    else:
+        page = get_submissions_page(SUBMISSION_STATUSES[status], before, limit)
+
+    submissions = [
+        {"job_id": job_id, "date": dat_time, "pdb_code": pdb_code, "subID": sub_id}
+        for job_id, dat_time, pdb_code, sub_id in page
+    ]
+    cursor = submissions[-1]["job_id"] if len(submissions) == limit else None
+
+    response = jsonify({"submissions": submissions, "next": cursor})
     response.headers.add("Access-Control-Allow-Origin", "*")
 
     return response
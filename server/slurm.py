@@ -1,18 +1,28 @@
 import os
+import json
 import logging
 import traceback
 import subprocess
+from threading import Lock, Thread
 from time import sleep
 import datetime
 from pypka import Titration
 from pypka import __version__ as pypka_version
+from sqlalchemy.dialects.postgresql import insert
 from models import Residue, Results, Pk, Input, Job
 from database import DB_SESSION
+from slurm_queue import parse_queue, is_queued
+from job_events import set_job_state
+from cost_model import DEFAULT_WALLTIME
 from dotenv import dotenv_values
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 CONFIG = dotenv_values(f"{DIR_PATH}/../.env")
 
+SBATCH = CONFIG.get("SBATCH") or "sbatch"
+SLURM_POLL_INTERVAL = float(CONFIG.get("SLURM_POLL_INTERVAL") or 5)
+SLURM_JOBS_KEY = "pypka:slurm_jobs"
+
 logging.basicConfig(filename="server.log", level=logging.DEBUG)
 
 root = logging.getLogger("werkzeug")
@@ -83,14 +93,55 @@ def report_error(job_id, error_msg, pid):
         )
         session.add(new_results)
         session.commit()
-        new_input = Input(job_id=job_id, protein_id=pid)
-        session.add(new_input)
+        # the protein is unknown if the job failed while being dispatched
+        has_input = session.query(Input.job_id).filter(Input.job_id == job_id).first()
+        if pid is not None and not has_input:
+            new_input = Input(job_id=job_id, protein_id=pid)
+            session.add(new_input)
+        set_job_state(session, job_id, "failed")
         session.commit()
 
 
+def residue_key(chain, res_name, res_number):
+    # character(n) columns come back padded with spaces
+    return (chain.strip(), res_name.strip(), int(res_number))
+
+
+def upsert_residues(session, pid, pKas, chunk_size=5000):
+    """Inserts the missing residues of a protein and maps them to their res_id"""
+    residues = {}
+    for chain, res_name, res_number, _ in pKas:
+        residues[residue_key(chain, res_name, res_number)] = {
+            "protein_id": pid,
+            "chain": chain,
+            "res_name": res_name,
+            "res_number": res_number,
+        }
+    residues = list(residues.values())
+
+    res_ids = {}
+    for i in range(0, len(residues), chunk_size):
+        stmt = insert(Residue).values(residues[i : i + chunk_size])
+        # the no-op update makes RETURNING include the residues that already existed
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["protein_id", "chain", "res_name", "res_number"],
+            set_={"res_name": stmt.excluded.res_name},
+        ).returning(Residue.res_id, Residue.chain, Residue.res_name, Residue.res_number)
+        for res_id, chain, res_name, res_number in session.execute(stmt):
+            res_ids[residue_key(chain, res_name, res_number)] = res_id
+    return res_ids
+
+
 def run_pypka_job(job_params, subID, job_id, pid):
     logging.info(f"{subID} added to the Queue")
 
+    with DB_SESSION() as session:
+        session.query(Job).filter(Job.job_id == job_id).update(
+            {Job.dat_time_start: datetime.datetime.today()}
+        )
+        set_job_state(session, job_id, "started")
+        session.commit()
+
     try:
         response_dict, final_params = run_pypka(job_params, subID, get_params=True)
         response_dict["error"] = None
@@ -124,6 +175,7 @@ def run_pypka_job(job_params, subID, job_id, pid):
         "ser_thr_titration",
         "cutoff",
         "slice",
+        "ncpus",
     ]
 
     pypka_params, delphi_params, mc_params = final_params
@@ -135,76 +187,58 @@ def run_pypka_job(job_params, subID, job_id, pid):
     else:
         mc_params["pH_values"] = list(mc_params["pH_values"])
 
-    logging.info(f"Inserting into Input")
-
-    new_input = Input(
-        job_id=job_id,
-        protein_id=pid,
-        pypka_set=pypka_params,
-        pb_set=delphi_params,
-        mc_set=mc_params,
-    )
-    DB_SESSION.add(new_input)
-    DB_SESSION.commit()
-
-    logging.info(f'inserting {response_dict["pKas"]} pKa values')
-
-    for chain, res_name, res_number, pK in response_dict["pKas"]:
-        resid = (
-            DB_SESSION.query(Residue.res_id)
-            .filter(Residue.protein_id == pid)
-            .filter(Residue.res_name == res_name)
-            .filter(Residue.chain == chain)
-            .filter(Residue.res_number == res_number)
-            .first()
-        )
-        if resid:
-            resid = resid[0]
-        else:
-            new_residue = Residue(
-                protein_id=pid,
-                res_name=res_name,
-                chain=chain,
-                res_number=res_number,
-            )
-            DB_SESSION.add(new_residue)
-            DB_SESSION.commit()
-            resid = new_residue.res_id
-        if pK == "-":
-            pK = None
-        new_pk = Pk(job_id=job_id, res_id=resid, pk=pK)
-        DB_SESSION.add(new_pk)
-        DB_SESSION.commit()
-
-    logging.info(f"inserting Results")
+    logging.info(f'inserting {len(response_dict["pKas"])} pKa values and results')
 
     pdb_out_ph = None
     if "structure_output" in job_params:
         logging.error(f'structure_out -> {job_params["structure_output"]}')
         pdb_out_ph = job_params["structure_output"][1]
-    new_results = Results(
-        job_id=job_id,
-        tit_curve=response_dict["titration"],
-        isoelectric_point=response_dict["pI"],
-        pdb_out=response_dict["pdb_out"],
-        pdb_out_ph=pdb_out_ph,
-    )
-    DB_SESSION.add(new_results)
-    DB_SESSION.commit()
 
-    job = DB_SESSION.query(Job).filter(Job.job_id == job_id).first()
-    job.dat_time_finish = datetime.datetime.today()
-    DB_SESSION.commit()
+    with DB_SESSION() as session:
+        session.add(
+            Input(
+                job_id=job_id,
+                protein_id=pid,
+                pypka_set=pypka_params,
+                pb_set=delphi_params,
+                mc_set=mc_params,
+            )
+        )
+
+        res_ids = upsert_residues(session, pid, response_dict["pKas"])
+        new_pks = []
+        for chain, res_name, res_number, pK in response_dict["pKas"]:
+            if pK == "-":
+                pK = None
+            res_id = res_ids[residue_key(chain, res_name, res_number)]
+            new_pks.append({"job_id": job_id, "res_id": res_id, "pk": pK})
+        if new_pks:
+            session.execute(insert(Pk), new_pks)
+
+        session.add(
+            Results(
+                job_id=job_id,
+                tit_curve=response_dict["titration"],
+                isoelectric_point=response_dict["pI"],
+                pdb_out=response_dict["pdb_out"],
+                pdb_out_ph=pdb_out_ph,
+            )
+        )
+        session.query(Job).filter(Job.job_id == job_id).update(
+            {Job.dat_time_finish: datetime.datetime.today()}
+        )
+        set_job_state(session, job_id, "finished")
+        session.commit()
 
     # if outputemail:
     #    send_email(outputemail)
 
-    DB_SESSION.close()
+    DB_SESSION.remove()
 
     logging.info(f"{subID} exiting")
 
 
-def create_slurm_file(params, subID, job_id, pid):
+def create_slurm_file(params, subID, job_id, pid, resources=None):
     slurm_f = f"{DIR_PATH}/submissions/slurm_{subID}.py"
     with open(slurm_f, "w") as f:
         f.write(
@@ -217,25 +251,95 @@ run_pypka_job({params}, {subID}, {job_id}, {pid})
 """
         )
 
-    submit_job(subID, slurm_f)
-
-    in_queue = True
-    while in_queue:
-        sleep(5)
-        sbrun = subprocess.run(
-            f"{CONFIG['SID']} | grep {subID} | wc -l",
-            shell=True,
-            capture_output=True,
+    if resources:
+        slurm_id = submit_job(
+            subID,
+            slurm_f,
+            ncores=resources.ncores,
+            partitions=resources.partitions,
+            walltime=resources.walltime,
         )
-        in_queue = int(sbrun.stdout.decode("utf-8").strip())
+    else:
+        slurm_id = submit_job(subID, slurm_f)
+    SLURM_MONITOR.track(subID, job_id, pid, slurm_id)
 
     with DB_SESSION() as session:
-        has_reported = (
-            session.query(Results.job_id).filter(Results.job_id == job_id).all()
-        )
+        set_job_state(session, job_id, "queued")
+        session.commit()
+    DB_SESSION.remove()
+
+
+class SlurmMonitor:
+    """Single poller of the SLURM queue for every submitted job
+
+    Each interval the queue is listed once and every tracked job that
+    left it is finalized: jobs that did not report any results are marked
+    as cancelled due to the time limit. With a redis `store` the tracked
+    jobs are also kept in SLURM_JOBS_KEY so a restarted process can
+    restore them.
+    """
+
+    def __init__(self, command, interval, store=None):
+        self.command = command
+        self.interval = interval
+        self.store = store
+        self.jobs = {}
+        self.lock = Lock()
+        self.thread = None
+
+    def track(self, subID, job_id, pid, slurm_id=None):
+        job = {"job_id": job_id, "pid": pid, "slurm_id": slurm_id}
+        if self.store is not None:
+            self.store.hset(SLURM_JOBS_KEY, subID, json.dumps(job))
+        with self.lock:
+            self.jobs[subID] = job
+            if self.thread is None:
+                self.thread = Thread(target=self.loop, daemon=True)
+                self.thread.start()
+
+    def loop(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                logging.error(traceback.format_exc())
+
+    def check(self):
+        with self.lock:
+            jobs = dict(self.jobs)
+        if not jobs:
+            return
+
+        sbrun = subprocess.run(self.command, shell=True, capture_output=True)
+        if sbrun.returncode != 0:
+            logging.error(f'SLURM QUEUE -> {sbrun.stderr.decode("utf-8").strip()}')
+            return
+        queue = parse_queue(sbrun.stdout.decode("utf-8"))
+
+        for subID, job in jobs.items():
+            if job["slurm_id"] in queue or is_queued(subID, queue):
+                continue
+            with self.lock:
+                del self.jobs[subID]
+            if self.store is not None:
+                self.store.hdel(SLURM_JOBS_KEY, subID)
+            self.finish(subID, job["job_id"], job["pid"])
+
+    def restore(self):
+        for subID, job in self.store.hgetall(SLURM_JOBS_KEY).items():
+            job = json.loads(job)
+            self.track(subID.decode("utf-8"), **job)
+
+    @staticmethod
+    def finish(subID, job_id, pid, error_msg="Job cancelled due to time limit"):
+        with DB_SESSION() as session:
+            has_reported = (
+                session.query(Results.job_id).filter(Results.job_id == job_id).all()
+            )
+        DB_SESSION.remove()
         logging.info(f"{subID} has reported: {has_reported}")
         if not has_reported:
-            error_msg = "Job cancelled due to time limit"
             report_error(job_id, error_msg, pid)
 
 
@@ -256,11 +360,12 @@ def submit_job(
     job_script,
     ncores=CONFIG["SLURM_JOB_NCORES"],
     partitions=CONFIG["SLURM_PARTITIONS"],
+    walltime=DEFAULT_WALLTIME,
 ):
     n_machines_idling = check_idle_machines()
     logging.info(f"MACHINES IDLE: {n_machines_idling}")
 
-    cmd = f"sbatch -p {partitions} -N 1 -n {ncores} -t 240 -o {DIR_PATH}/submissions/{job_name}.out -e {DIR_PATH}/submissions/{job_name}.out {job_script}"
+    cmd = f"{SBATCH} -p {partitions} -N 1 -n {ncores} -t {walltime} -o {DIR_PATH}/submissions/{job_name}.out -e {DIR_PATH}/submissions/{job_name}.out {job_script}"
     logging.info(cmd)
 
     # os.system(cmd)
@@ -269,7 +374,13 @@ def submit_job(
         shell=True,
         capture_output=True,
     )
-    logging.info(f'SLURM SUBMISSION -> {sbrun.stdout.decode("utf-8").strip()}')
+    sbatch_out = sbrun.stdout.decode("utf-8").strip()
+    logging.info(f"SLURM SUBMISSION -> {sbatch_out}")
+
+    # "Submitted batch job <id>"
+    if sbatch_out.startswith("Submitted batch job"):
+        return sbatch_out.split()[-1]
+    return None
 
 
 def submit_job_CESGA(job_name, job_script, ncores=16, partitions="debug"):
@@ -322,3 +433,6 @@ def submit_job_CESGA(job_name, job_script, ncores=16, partitions="debug"):
     if not os.path.isfile(f"{DIR_PATH}/submissions/{job_name}.out"):
         logging.info(f"RESUBMITTING {job_name}")
         submit_job(job_name, job_script, ncores=16, partitions="debug")
+
+
+SLURM_MONITOR = SlurmMonitor(CONFIG.get("SID"), SLURM_POLL_INTERVAL)
@@ -0,0 +1,65 @@
+import asyncio
+import logging
+
+
+def parse_queue(output):
+    """Maps the SLURM job id of every queue line to the line itself
+
+    Works on squeue-like output where the job id is the first column;
+    header and blank lines are skipped.
+    """
+    queue = {}
+    for line in output.splitlines():
+        cols = line.split()
+        if not cols or not cols[0][0].isdigit():
+            continue
+        queue[cols[0]] = line
+    return queue
+
+
+def is_queued(subID, queue):
+    return any(subID in line for line in queue.values())
+
+
+class QueueSnapshot:
+    """SLURM queue shared by every results stream subscriber
+
+    A single asyncio task refreshes it every interval with a non-blocking
+    subprocess, so lookups cost the same regardless of the open streams.
+    """
+
+    def __init__(self, command, interval):
+        self.command = command
+        self.interval = interval
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.loop())
+
+    async def loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error(f"SLURM QUEUE -> {e}")
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self):
+        proc = await asyncio.create_subprocess_shell(
+            self.command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            logging.error(f'SLURM QUEUE -> {stderr.decode("utf-8").strip()}')
+            return
+        self.queue = parse_queue(stdout.decode("utf-8"))
+
+    def is_queued(self, subID):
+        # until the first refresh the stored results decide on their own
+        if self.queue is None:
+            return False
+        return is_queued(subID, self.queue)
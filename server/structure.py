@@ -0,0 +1,71 @@
+import numpy as np
+
+
+class Structure:
+    """ATOM records of a PDB file parsed once into column arrays
+
+    Columns are cut at the fixed PDB positions for all lines at once, and
+    the per-chain residue names are indexed up front so the pka2pI stages
+    can share one parse instead of re-reading the file.
+    """
+
+    def __init__(self, lines, filename=None):
+        self.lines = lines
+        self.filename = filename
+
+        natoms = len(lines)
+        chars = (
+            np.array(
+                [line[:54].rstrip("\n").ljust(54) for line in lines], dtype="S54"
+            )
+            .view("S1")
+            .reshape(natoms, 54)
+        )
+
+        def column(start, end):
+            return chars[:, start:end].copy().view(f"S{end - start}").ravel()
+
+        self.atom_names = np.char.strip(np.char.decode(column(12, 16)))
+        self.resnames = np.char.strip(np.char.decode(column(17, 21)))
+        self.chains = np.char.decode(column(21, 22))
+        self.resnumbs = column(22, 26).astype(int)
+        self.coords = np.stack(
+            [column(30, 38), column(38, 46), column(46, 54)], axis=1
+        ).astype(float)
+        try:
+            self.atom_numbers = column(6, 11).astype(int)
+        except ValueError:
+            # hybrid-36 or overflowed serial numbers
+            self.atom_numbers = np.arange(1, natoms + 1)
+
+        self.chain_list = list(dict.fromkeys(self.chains.tolist()))
+        self.residues = {chain: {} for chain in self.chain_list}
+        for chain, resnumb, resname in zip(
+            self.chains.tolist(), self.resnumbs.tolist(), self.resnames.tolist()
+        ):
+            self.residues[chain][resnumb] = resname
+
+    def __len__(self):
+        return len(self.lines)
+
+    @classmethod
+    def from_pdb(cls, fname, first_model_only=False):
+        lines = []
+        with open(fname) as f:
+            for line in f:
+                if line.startswith("ATOM "):
+                    lines.append(line)
+                elif first_model_only and line.startswith("END"):
+                    break
+        return cls(lines, filename=fname)
+
+    def write(self, fname):
+        with open(fname, "w") as f_new:
+            f_new.write("".join(self.lines))
+        self.filename = fname
+
+
+def as_structure(pdb):
+    if isinstance(pdb, Structure):
+        return pdb
+    return Structure.from_pdb(pdb)
@@ -0,0 +1,107 @@
+import math
+import logging
+from time import monotonic
+
+from redis import Redis
+from rq import Queue
+from rq.job import JobStatus
+
+from database import DB_SESSION
+from models import Job, Input
+from slurm import SLURM_JOBS_KEY, SlurmMonitor
+from backends import LOCAL_JOBS_KEY, LOCAL_TIME_LIMIT
+from pypka_jobs import submit_pypka_job
+from const import CONFIG
+
+REDIS_URL = CONFIG.get("REDIS_URL") or "redis://localhost:6379/0"
+SUBMISSION_QUEUE_NAME = "pypka_submissions"
+SUBMISSION_QUEUE_SIZE = int(CONFIG.get("SUBMISSION_QUEUE_SIZE") or 100)
+DISPATCHER_WORKERS = int(CONFIG.get("DISPATCHER_WORKERS") or 2)
+DISPATCH_TIMEOUT = int(CONFIG.get("DISPATCH_TIMEOUT") or 600)  # seconds
+# local jobs run inside the dispatch task
+TASK_TIMEOUT = DISPATCH_TIMEOUT + int(LOCAL_TIME_LIMIT) + 60
+
+# moving average of the seconds taken to dispatch one submission
+DISPATCH_SECONDS_KEY = "pypka:dispatch_seconds"
+DISPATCH_SECONDS_DEFAULT = 5
+DISPATCH_SECONDS_WEIGHT = 0.2
+
+REDIS = Redis.from_url(REDIS_URL)
+SUBMISSION_QUEUE = Queue(SUBMISSION_QUEUE_NAME, connection=REDIS)
+
+
+class QueueFull(Exception):
+    pass
+
+
+def dispatch_submission(job_params, sub_params, subID):
+    """rq task: registers the job and hands it to an execution backend"""
+    start = monotonic()
+    submit_pypka_job(job_params, sub_params, subID)
+    elapsed = monotonic() - start
+
+    average = get_dispatch_seconds()
+    average += DISPATCH_SECONDS_WEIGHT * (elapsed - average)
+    REDIS.set(DISPATCH_SECONDS_KEY, average)
+
+
+def get_dispatch_seconds():
+    average = REDIS.get(DISPATCH_SECONDS_KEY)
+    return float(average) if average else DISPATCH_SECONDS_DEFAULT
+
+
+def enqueue_submission(job_params, sub_params, subID):
+    """Persists a submission in the queue, raises QueueFull when it is full"""
+    if SUBMISSION_QUEUE.count >= SUBMISSION_QUEUE_SIZE:
+        raise QueueFull()
+    SUBMISSION_QUEUE.enqueue_call(
+        dispatch_submission,
+        args=(job_params, sub_params, subID),
+        job_id=f"pypka-{subID}",
+        timeout=TASK_TIMEOUT,
+        result_ttl=0,
+        failure_ttl=7 * 24 * 3600,
+    )
+
+
+def fail_orphaned_submissions():
+    """Reports the jobs whose dispatch was cut short by a dispatcher restart
+
+    Must run before this dispatcher starts its workers: any job still
+    submitted whose task is not waiting in the queue was being dispatched
+    by the previous process.
+    """
+    with DB_SESSION() as session:
+        jobs = (
+            session.query(Job.sub_id, Job.job_id, Input.protein_id)
+            .outerjoin(Input, Input.job_id == Job.job_id)
+            .filter(Job.status == "submitted")
+            .all()
+        )
+    DB_SESSION.remove()
+
+    for subID, job_id, pid in jobs:
+        task = SUBMISSION_QUEUE.fetch_job(f"pypka-{subID}")
+        if task is not None and task.get_status() == JobStatus.QUEUED:
+            continue
+        logging.warning(f"{subID} dispatch interrupted by a restart")
+        SlurmMonitor.finish(subID, job_id, pid, "Job interrupted by a server restart")
+
+
+def get_queue_stats():
+    """Sizes of the submission stages and the wait until a new one is dispatched
+
+    dispatch_wait does not include the time a job then spends queued in
+    SLURM or running.
+    """
+    queued = SUBMISSION_QUEUE.count
+    dispatching = SUBMISSION_QUEUE.started_job_registry.count
+    waves = math.ceil((queued + dispatching) / DISPATCHER_WORKERS)
+    return {
+        "queued": queued,
+        "dispatching": dispatching,
+        "submitted": REDIS.hlen(SLURM_JOBS_KEY),
+        "running_locally": REDIS.hlen(LOCAL_JOBS_KEY),
+        "max_size": SUBMISSION_QUEUE_SIZE,
+        "dispatch_wait": round(waves * get_dispatch_seconds(), 1),
+    }
@@ -0,0 +1,123 @@
+import atexit
+import datetime
+import logging
+from threading import Event, Lock, Thread
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+from const import CONFIG
+from database import DB_SESSION
+from models import UsageStats, UsageStatsBucket
+
+USAGE_FLUSH_INTERVAL = float(CONFIG.get("USAGE_FLUSH_INTERVAL") or 10)
+USAGE_BUCKET_SECONDS = int(CONFIG.get("USAGE_BUCKET_SECONDS") or 300)
+
+COUNTERS = ("pkpdb_queries", "pkpdb_downloads", "pypka_subs", "pkai_subs")
+
+
+def get_bucket(timestamp):
+    epoch = timestamp.timestamp()
+    return datetime.datetime.fromtimestamp(epoch - epoch % USAGE_BUCKET_SECONDS)
+
+
+class UsageCounter:
+    """Aggregates usage increments in memory and flushes them periodically
+
+    A flush adds the pending counts to usage_stats with a single atomic
+    UPDATE and to the time-bucketed usage_stats_bucket table. Counts are
+    also flushed when the process exits.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = {}
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+
+    def add(self, counter, n=1):
+        with self.lock:
+            self.pending[counter] = self.pending.get(counter, 0) + n
+            if self.thread is None:
+                self.thread = Thread(target=self.loop, daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+
+    def get_pending(self):
+        with self.lock:
+            return dict(self.pending)
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+
+        bucket = get_bucket(datetime.datetime.now())
+        try:
+            with DB_SESSION() as session:
+                session.query(UsageStats).update(
+                    {
+                        getattr(UsageStats, counter): getattr(UsageStats, counter) + n
+                        for counter, n in pending.items()
+                    },
+                    synchronize_session=False,
+                )
+
+                stmt = insert(UsageStatsBucket).values(
+                    [
+                        {"bucket": bucket, "counter": counter, "count": n}
+                        for counter, n in pending.items()
+                    ]
+                )
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=["bucket", "counter"],
+                    set_={"count": UsageStatsBucket.count + stmt.excluded.count},
+                )
+                session.execute(stmt)
+                session.commit()
+        except Exception as e:
+            logging.error(f"Usage stats flush failed: {e}")
+            with self.lock:
+                for counter, n in pending.items():
+                    self.pending[counter] = self.pending.get(counter, 0) + n
+        finally:
+            DB_SESSION.remove()
+
+
+def get_recent_usage(session, since):
+    counts = (
+        session.query(UsageStatsBucket.counter, func.sum(UsageStatsBucket.count))
+        .filter(UsageStatsBucket.bucket >= get_bucket(since))
+        .group_by(UsageStatsBucket.counter)
+        .all()
+    )
+    return dict(counts)
+
+
+USAGE_COUNTER = UsageCounter(USAGE_FLUSH_INTERVAL)
+
+
+def plus_one_pkpdb_downloads():
+    USAGE_COUNTER.add("pkpdb_downloads")
+
+
+def plus_one_pkpdb_queries():
+    USAGE_COUNTER.add("pkpdb_queries")
+
+
+def plus_one_pypka_subs():
+    USAGE_COUNTER.add("pypka_subs")
+
+
+def plus_one_pkai_subs():
+    USAGE_COUNTER.add("pkai_subs")